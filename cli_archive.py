@@ -0,0 +1,102 @@
+import io, json, os, queue, re, tarfile, threading, time
+
+from cli_logger import logger
+
+SHARD_REGEX = re.compile(r"^shard-(\d+)\.tar$")
+INDEX_FILENAME = "index.jsonl"
+
+
+# Appends results into sharded tar files instead of writing every image as a file of its own.
+# The shards follow the WebDataset layout: all files of a sample share its key, like {key}.png and {key}.json
+# with its metadata. Once a shard reaches shard_size MB, the next sample starts a new one. A new run never
+# touches the shards of the previous ones, it just carries on with the numbering.
+# Every sample also gets a line in index.jsonl with its metadata, the shard it is in, and the offset and size
+# of its image in that shard, so that a single image can be read without going through the whole tar.
+# Samples are written by a background thread, so the event loop never waits for the disk.
+class ArchiveWriter(object):
+    def __init__(self, directory, shard_size=1024):
+        self.directory = directory
+        self.shard_size = shard_size * 1024 * 1024
+        self.queue = queue.Queue()
+        self.thread = None
+        self.tar = None
+        self.shard = None
+        self.next_shard = 0
+        self.index = None
+        self.written = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        shards = [int(match.group(1)) for match in map(SHARD_REGEX.match, os.listdir(self.directory)) if match]
+        self.next_shard = max(shards, default=-1) + 1
+        self.index = open(os.path.join(self.directory, INDEX_FILENAME), "a", encoding="utf-8")
+        self.thread = threading.Thread(target=self.run, name="archive-writer", daemon=True)
+        self.thread.start()
+        return(self)
+
+    # files maps the extension of every file of the sample to its bytes, or to the path of a file to move into the shard
+    def add(self, key, files, metadata):
+        self.queue.put((key, files, metadata))
+
+    # Waits for everything queued to be written and closes the shard
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.tar is not None:
+            self.tar.close()
+        self.index.close()
+        if self.written:
+            logger.message(f"Archived {self.written} results into {self.directory}")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, files, metadata = item
+            try:
+                self.write_sample(key, files, metadata)
+            except (OSError, tarfile.TarError) as err:
+                logger.error(f"Could not archive {key}: {err}")
+
+    def open_shard(self):
+        if self.tar is not None:
+            if self.tar.offset < self.shard_size:
+                return
+            self.tar.close()
+        self.shard = f"shard-{self.next_shard:06d}.tar"
+        self.next_shard += 1
+        self.tar = tarfile.open(os.path.join(self.directory, self.shard), "w", format=tarfile.PAX_FORMAT)
+        logger.info(f"Writing results into {self.shard}")
+
+    def add_member(self, name, content):
+        info = tarfile.TarInfo(name)
+        info.mtime = time.time()
+        if type(content) is str:
+            info.size = os.path.getsize(content)
+            with open(content, "rb") as handler:
+                self.tar.addfile(info, handler)
+            os.remove(content)
+        else:
+            info.size = len(content)
+            self.tar.addfile(info, io.BytesIO(content))
+        # The data sits right before the end of the member, which is padded to full blocks
+        padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return(self.tar.offset - padded_size, info.size)
+
+    def write_sample(self, key, files, metadata):
+        self.open_shard()
+        entry = {"key": key, "shard": self.shard, "files": {}}
+        for extension, content in files.items():
+            offset, size = self.add_member(f"{key}.{extension}", content)
+            entry["files"][extension] = {"offset": offset, "size": size}
+        self.add_member(f"{key}.json", json.dumps(metadata, default=str).encode("utf-8"))
+        entry.update(metadata)
+        # The index only points to samples which are completely in the shard
+        self.tar.fileobj.flush()
+        self.index.write(json.dumps(entry, default=str) + "\n")
+        self.index.flush()
+        self.written += 1
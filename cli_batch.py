@@ -0,0 +1,156 @@
+import csv, json, os, sys, time, copy
+
+from collections import Counter
+from cli_logger import logger
+from cli_metrics import percentile
+
+# Keys of a batch entry which are not generation params
+SUBMIT_KEYS = {"prompt", "nsfw", "censor_nsfw", "trusted_workers", "slow_workers", "shared", "replacement_filter", "r2", "models", "workers"}
+REQUEST_KEYS = {"filename", "source_image", "source_processing", "source_mask", "priority"}
+
+
+def _coerce_csv_value(value):
+    # CSV cells are always strings, so we try to give them back their intended types
+    value = value.strip()
+    if value == "":
+        return(None)
+    if value.lower() in ["true", "false"]:
+        return(value.lower() == "true")
+    if value.startswith("[") or value.startswith("{"):
+        import yaml
+        try:
+            return(yaml.safe_load(value))
+        except yaml.YAMLError as err:
+            raise ValueError(f"Could not read the list or mapping {value}: {err}")
+    for cast in [int, float]:
+        try:
+            return(cast(value))
+        except ValueError:
+            pass
+    return(value)
+
+
+def _normalize_entry(entry, line):
+    # A bare string is just a prompt
+    if type(entry) is str:
+        return({"prompt": entry})
+    if type(entry) is not dict:
+        raise ValueError(f"Batch entry {line} has to be a prompt string or a mapping of parameters. Got: {entry}")
+    return(entry)
+
+
+# Reads a JSONL, CSV or YAML file into a list of dictionaries of request overrides.
+# A file which can't be read stops the run with an error
+def load_batch_file(batch_file):
+    try:
+        return(_read_batch_file(batch_file))
+    except (OSError, ValueError) as err:
+        logger.error(f"Could not load the batch file {batch_file}: {err}")
+        sys.exit(1)
+
+
+def _read_batch_file(batch_file):
+    if not os.path.exists(batch_file):
+        raise FileNotFoundError("The file does not exist")
+    extension = os.path.splitext(batch_file)[1].lower()
+    entries = []
+    with open(batch_file, "rt", encoding="utf-8", errors="ignore") as batchfile:
+        if extension in [".jsonl", ".ndjson"]:
+            for line_no, line in enumerate(batchfile, start=1):
+                if line.strip() == "":
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as err:
+                    raise ValueError(f"Line {line_no} is not valid JSON: {err}")
+                entries.append(_normalize_entry(entry, line_no))
+        elif extension == ".csv":
+            for line_no, row in enumerate(csv.DictReader(batchfile), start=2):
+                entry = {}
+                for key, value in row.items():
+                    if key is None or value is None:
+                        continue
+                    value = value.strip() if key in ["prompt", "filename"] else _coerce_csv_value(value)
+                    if value not in [None, ""]:
+                        entry[key.strip()] = value
+                entries.append(_normalize_entry(entry, line_no))
+        elif extension in [".yml", ".yaml"]:
+            import yaml
+            try:
+                loaded = yaml.safe_load(batchfile)
+            except yaml.YAMLError as err:
+                raise ValueError(f"Not valid YAML: {err}")
+            if type(loaded) is dict:
+                loaded = loaded.get("jobs", [])
+            if loaded is not None and type(loaded) is not list:
+                raise ValueError(f"Has to be a list of entries, or a mapping with a 'jobs' list. Got: {loaded!r}")
+            for line_no, entry in enumerate(loaded or [], start=1):
+                entries.append(_normalize_entry(entry, line_no))
+        else:
+            raise ValueError(f"Unknown batch file type '{extension}'. Please use .jsonl, .csv or .yml")
+    return(entries)
+
+
+# Returns a copy of request_data with the batch entry applied on top of it.
+# Known request keys go to the submit_dict or request_data attributes. Anything else is a generation param.
+# Only the submit_dict and the params are copied, as they are the only parts an entry changes. Everything
+# else, like the models list or the post-processors, is shared with request_data by all the jobs of the batch
+def apply_overrides(request_data, entry, params_attr):
+    job_data = copy.copy(request_data)
+    job_data.submit_dict = dict(request_data.submit_dict)
+    params = dict(getattr(request_data, params_attr))
+    setattr(job_data, params_attr, params)
+    job_data.payload = None
+    for key, value in entry.items():
+        if key in [params_attr, "params"]:
+            params.update(value)
+        elif key == "submit_dict":
+            job_data.submit_dict.update(value)
+        elif key in SUBMIT_KEYS:
+            job_data.submit_dict[key] = value
+        elif key in REQUEST_KEYS:
+            setattr(job_data, key, value)
+        else:
+            params[key] = value
+    return(job_data)
+
+
+class BatchStats(object):
+    def __init__(self):
+        self.start = time.monotonic()
+        self.states = Counter()
+        self.queue_waits = []
+        self.generation_times = []
+        self.kudos = 0
+
+    def record(self, state, timer=None, kudos=0):
+        self.states[state] += 1
+        self.kudos += kudos
+        if timer is None or state != "done":
+            return
+        if timer.queue_wait is not None:
+            self.queue_waits.append(timer.queue_wait)
+        if timer.generation_time is not None:
+            self.generation_times.append(timer.generation_time)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        finished = self.states["done"]
+        lines = [
+            f"Batch finished in {elapsed:.1f}s: " + ", ".join(f"{count} {state}" for state, count in sorted(self.states.items())),
+            f"Throughput: {finished / (elapsed / 60):.2f} jobs/minute" if elapsed > 0 else "Throughput: n/a",
+        ]
+        if self.kudos > 0 and finished > 0:
+            lines.append(f"Kudos: {self.kudos:.1f} spent, {self.kudos / finished:.2f} per finished job")
+        for name, values in [("Queue wait", self.queue_waits), ("Generation time", self.generation_times)]:
+            if not values:
+                continue
+            lines.append(
+                f"{name}: " + ", ".join(f"p{pct}={percentile(values, pct):.1f}s" for pct in [50, 90, 99])
+                + f", max={max(values):.1f}s"
+            )
+        return(lines)
+
+    def log_summary(self):
+        for line in self.summary():
+            logger.message(line)
@@ -0,0 +1,177 @@
+import argparse, json, os, subprocess, sys, tempfile, time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from cli_logger import logger, set_logger_verbosity, quiesce_logger
+from cli_metrics import percentile
+from cli_mock_horde import start_mock_horde, add_mock_args, get_mock_settings
+
+try:
+    import resource
+except ImportError:
+    # Not available on windows, where we just don't report the peak memory
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENTS = {
+    "dream": ["cli_request_dream.py"],
+    "scribe": ["cli_request_scribe.py"],
+    "alchemy": ["cli_request_alchemy.py", "--source_image", os.path.join(REPO_DIR, "db0.jpg")],
+}
+
+arg_parser = argparse.ArgumentParser(description="Benchmarks the CLIs against a local mock horde, or any horde passed with --horde")
+arg_parser.add_argument('-c', '--client', action="store", required=False, type=str, default="all", choices=list(CLIENTS) + ["all"], help="Which CLI to benchmark")
+arg_parser.add_argument('-n', '--jobs', action="store", required=False, type=int, default=20, help="How many jobs to run per CLI")
+arg_parser.add_argument('--mode', action="store", required=False, type=str, default="single", choices=["single", "batch"], help="single starts one process per job. batch sends all jobs to a single dream process with --batch_file")
+arg_parser.add_argument('--parallel', action="store", required=False, type=int, default=4, help="In single mode, how many CLI processes run at the same time. In batch mode, the --concurrency of the batch")
+arg_parser.add_argument('--horde', action="store", required=False, type=str, help="Benchmark against this horde instead of starting a mock one")
+arg_parser.add_argument('--output', action="store", required=False, type=str, help="Also write the results as json to this file, to compare them between changes")
+arg_parser.add_argument('--entry', action="store", required=False, type=str, default="script", choices=["script", "horde"], help="Run the cli_request_*.py scripts directly, or through the subcommands of horde.py")
+arg_parser.add_argument('--import_runs', action="store", required=False, type=int, default=5, help="How many fresh processes to time the import of each CLI with. 0 skips it")
+arg_parser.add_argument('--cli_args', action="store", required=False, type=str, default="", help="Extra arguments passed to every CLI run, as a single string")
+arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
+arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
+add_mock_args(arg_parser)
+
+
+def get_mock_stats(horde_url, reset=False):
+    if reset:
+        urllib.request.urlopen(urllib.request.Request(f"{horde_url}/mock/reset", data=b"{}", method="POST")).read()
+        return({})
+    with urllib.request.urlopen(f"{horde_url}/mock/stats") as response:
+        return(json.loads(response.read()))
+
+
+def run_cli(client, cli_args, workdir, entry="script"):
+    if entry == "horde":
+        command = [sys.executable, os.path.join(REPO_DIR, "horde.py"), client]
+    else:
+        command = [sys.executable, os.path.join(REPO_DIR, CLIENTS[client][0])]
+    command += CLIENTS[client][1:] + cli_args
+    start = time.monotonic()
+    cli_run = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    elapsed = time.monotonic() - start
+    if cli_run.returncode != 0:
+        logger.error(f"{client} exited with {cli_run.returncode}: {cli_run.stderr[-1000:]}")
+    return(elapsed, cli_run.returncode)
+
+
+# How long a fresh process takes to import a CLI, which every single run pays before sending anything
+def measure_import_time(client, runs):
+    module = os.path.splitext(CLIENTS[client][0])[0]
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    times = []
+    for _ in range(runs):
+        import_run = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True)
+        if import_run.returncode != 0:
+            logger.error(f"Importing {module} failed: {import_run.stderr[-1000:]}")
+            return(None)
+        times.append(float(import_run.stdout))
+    return(percentile(times, 50))
+
+
+# One CLI process per job, with up to `parallel` of them at the same time. The latency of a job is the lifetime of its process
+def benchmark_single(client, jobs, parallel, common_args, workdir, entry):
+    def run_job(index):
+        return(run_cli(client, common_args + ["-f", f"bench_{index}.png"] if client == "dream" else common_args, workdir, entry))
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        runs = list(executor.map(run_job, range(jobs)))
+    return([elapsed for elapsed, returncode in runs], sum(1 for elapsed, returncode in runs if returncode != 0))
+
+
+# All jobs go to a single dream process. The latency of a job comes from its phase timings
+def benchmark_batch(client, jobs, parallel, common_args, workdir, entry):
+    if client != "dream":
+        raise ValueError("Only the dream CLI has a batch mode")
+    batch_file = os.path.join(workdir, "bench_batch.jsonl")
+    metrics_file = os.path.join(workdir, "bench_metrics.jsonl")
+    with open(batch_file, 'w') as handler:
+        for index in range(jobs):
+            handler.write(json.dumps({"prompt": f"benchmark prompt {index}", "seed": str(index)}) + "\n")
+    elapsed, returncode = run_cli(client, common_args + ["--batch_file", batch_file, "--concurrency", str(parallel), "--metrics_jsonl", metrics_file], workdir, entry)
+    latencies = []
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as handler:
+            for line in handler:
+                job_metrics = json.loads(line)
+                if job_metrics["state"] != "done":
+                    continue
+                latencies.append(sum(seconds for phase, seconds in job_metrics["phases"].items() if phase != "encode"))
+    return(latencies, jobs - len(latencies))
+
+
+def benchmark(client, args, horde_url, workdir):
+    # A running daemon would take the jobs to its own horde, and leave the timings of the CLI itself out
+    common_args = ["--horde", horde_url, "--no_daemon"] + args.cli_args.split()
+    if args.horde is None:
+        get_mock_stats(horde_url, reset=True)
+    start = time.monotonic()
+    if args.mode == "batch":
+        latencies, failures = benchmark_batch(client, args.jobs, args.parallel, common_args, workdir, args.entry)
+    else:
+        latencies, failures = benchmark_single(client, args.jobs, args.parallel, common_args, workdir, args.entry)
+    wall_time = time.monotonic() - start
+    results = {
+        "client": client,
+        "mode": args.mode,
+        "entry": args.entry,
+        "jobs": args.jobs,
+        "failures": failures,
+        "wall_time": round(wall_time, 3),
+        "jobs_per_minute": round(args.jobs / (wall_time / 60), 2),
+        "latency": {f"p{pct}": round(percentile(latencies, pct), 3) for pct in [50, 95, 99]} if latencies else None,
+    }
+    if args.import_runs > 0:
+        import_time = measure_import_time(client, args.import_runs)
+        results["import_time"] = round(import_time, 4) if import_time is not None else None
+    if args.horde is None:
+        requests = get_mock_stats(horde_url)["requests"]
+        results["requests"] = requests
+        results["requests_per_job"] = round(sum(requests.values()) / args.jobs, 2)
+    return(results)
+
+
+def log_results(results):
+    latency = results["latency"] or {}
+    logger.message(
+        f"{results['client']} ({results['mode']}): {results['jobs']} jobs ({results['failures']} failed) in {results['wall_time']}s, "
+        f"{results['jobs_per_minute']} jobs/minute, latency " + ", ".join(f"{pct}={value}s" for pct, value in latency.items())
+    )
+    if "requests" in results:
+        logger.message(
+            f"{results['client']} ({results['mode']}): {results['requests_per_job']} requests/job ("
+            + ", ".join(f"{request_type}={count}" for request_type, count in sorted(results["requests"].items())) + ")"
+        )
+    if results.get("import_time") is not None:
+        logger.message(f"{results['client']}: importing takes {results['import_time'] * 1000:.0f}ms (median of fresh processes)")
+    if results.get("peak_rss_mb") is not None:
+        logger.message(f"Peak memory of the CLI processes so far: {results['peak_rss_mb']} MB")
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    set_logger_verbosity(args.verbosity)
+    quiesce_logger(args.quiet)
+    horde_url = args.horde
+    if horde_url is None:
+        server = start_mock_horde(**get_mock_settings(args))
+        horde_url = server.horde.base_url
+        logger.info(f"Started a mock horde on {horde_url}")
+    clients = list(CLIENTS) if args.client == "all" else [args.client]
+    if args.mode == "batch":
+        clients = ["dream"]
+    all_results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the CLIs' caches out of the user's home and away from other runs
+        os.environ["HORDE_CLI_CACHE"] = os.path.join(workdir, "cache")
+        for client in clients:
+            results = benchmark(client, args, horde_url, workdir)
+            if resource is not None:
+                # ru_maxrss is the biggest single child so far, in KB on linux
+                results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+            log_results(results)
+            all_results.append(results)
+    if args.output:
+        with open(args.output, 'w') as handler:
+            json.dump(all_results, handler, indent=4)
@@ -0,0 +1,329 @@
+import difflib, os, sys
+
+from collections import Counter
+from cli_logger import logger
+
+NONE = type(None)
+NUMBER = (int, float)
+
+SAMPLERS = ["k_lms", "k_heun", "k_euler", "k_euler_a", "k_dpm_2", "k_dpm_2_a", "k_dpm_fast", "k_dpm_adaptive", "k_dpmpp_2s_a", "k_dpmpp_2m", "dpmsolver", "k_dpmpp_sde", "lcm", "DDIM"]
+SOURCE_PROCESSINGS = ["img2img", "inpainting", "outpainting", "remix"]
+CONTROL_TYPES = ["canny", "hed", "depth", "normal", "openpose", "seg", "scribble", "fakescribbles", "hough"]
+POST_PROCESSORS = ["GFPGAN", "RealESRGAN_x4plus", "RealESRGAN_x2plus", "RealESRGAN_x4plus_anime_6B", "NMKD_Siax", "4x_AnimeSharp", "CodeFormers", "strip_background"]
+ALCHEMY_FORMS = ["caption", "interrogation", "nsfw"] + POST_PROCESSORS
+
+# The keys of the submit dict which every kind of request accepts
+COMMON_SUBMIT = {
+    "trusted_workers": bool,
+    "validated_backends": bool,
+    "slow_workers": bool,
+    "extra_slow_workers": bool,
+    "workers": list,
+    "worker_blacklist": bool,
+    "webhook": str,
+}
+GENERATION_SUBMIT = dict(COMMON_SUBMIT, **{
+    "prompt": str,
+    "models": list,
+    "dry_run": bool,
+    "proxied_account": str,
+    "disable_batching": bool,
+    "allow_downgrade": bool,
+    "style": str,
+})
+
+
+def _check_range(problems, params, key, low, high):
+    value = params.get(key)
+    if type(value) in NUMBER and not low <= value <= high:
+        problems.append(f"{key} is {value}, but has to be between {low} and {high}")
+
+
+def _check_choice(problems, name, value, choices):
+    if type(value) is str and value not in choices:
+        problems.append(f"Unknown {name} '{value}'{_suggest(value, choices)}")
+
+
+def _check_models(problems, models):
+    if type(models) is not list:
+        return
+    for model in models:
+        if type(model) is not str or model.strip() == "":
+            problems.append(f"models has to be a list of model names. Got: {model!r}")
+    duplicates = [model for model, count in Counter(model for model in models if type(model) is str).items() if count > 1]
+    if duplicates:
+        problems.append(f"models lists {sorted(duplicates)} more than once")
+
+
+def _check_file(problems, key, path):
+    if type(path) is str and not os.path.exists(path):
+        problems.append(f"The {key} '{path}' does not exist")
+
+
+def _suggest(key, choices):
+    matches = difflib.get_close_matches(key, choices, n=1)
+    if matches:
+        return(f". Did you mean '{matches[0]}'?")
+    return("")
+
+
+def check_image_request(request_data, problems):
+    params = request_data.imgen_params
+    for key in ["width", "height"]:
+        value = params.get(key)
+        if type(value) is int and value % 64 != 0:
+            problems.append(f"{key} is {value}, but has to be a multiple of 64")
+        _check_range(problems, params, key, 64, 3072)
+    _check_range(problems, params, "n", 1, 20)
+    _check_range(problems, params, "steps", 1, 500)
+    _check_range(problems, params, "cfg_scale", 0, 100)
+    _check_range(problems, params, "denoising_strength", 0.01, 1)
+    _check_range(problems, params, "hires_fix_denoising_strength", 0.01, 1)
+    _check_range(problems, params, "clip_skip", 1, 12)
+    _check_choice(problems, "sampler", params.get("sampler_name"), SAMPLERS)
+    _check_choice(problems, "control type", params.get("control_type"), CONTROL_TYPES)
+    for post_processor in params.get("post_processing") or []:
+        _check_choice(problems, "post-processor", post_processor, POST_PROCESSORS)
+    _check_choice(problems, "source processing", request_data.source_processing, SOURCE_PROCESSINGS)
+    _check_models(problems, request_data.submit_dict.get("models"))
+    _check_file(problems, "source_image", request_data.source_image)
+    _check_file(problems, "source_mask", request_data.source_mask)
+    if request_data.source_mask and not request_data.source_image:
+        problems.append("A source mask requires a source image")
+    if params.get("control_type") and not request_data.source_image:
+        problems.append("A control type requires a source image")
+
+
+def check_text_request(request_data, problems):
+    params = request_data.txtgen_params
+    _check_range(problems, params, "n", 1, 20)
+    _check_range(problems, params, "max_length", 16, 1024)
+    _check_range(problems, params, "max_context_length", 80, 32000)
+    max_length = params.get("max_length")
+    max_context_length = params.get("max_context_length")
+    if type(max_length) is int and type(max_context_length) is int and max_length > max_context_length:
+        problems.append(f"max_length ({max_length}) can't be more than max_context_length ({max_context_length})")
+    _check_models(problems, request_data.submit_dict.get("models"))
+
+
+def check_interrogate_request(request_data, problems):
+    forms = request_data.submit_dict.get("forms")
+    if type(forms) is list:
+        if not forms:
+            problems.append("forms needs at least one form")
+        for form in forms:
+            if type(form) is not dict or "name" not in form:
+                problems.append(f"Every form has to be a mapping with a name, like {{name: caption}}. Got: {form!r}")
+            else:
+                _check_choice(problems, "form", form["name"], ALCHEMY_FORMS)
+    if not request_data.source_image:
+        problems.append("Alchemy requires a source image")
+    _check_file(problems, "source_image", request_data.source_image)
+
+
+# What the request data of one of the CLIs may contain. attributes are the top level keys of its yml file,
+# with the types they accept. The generation params and the submit dict are checked key by key against
+# params and submit, so that a misspelled key is caught before the request is sent instead of being
+# silently ignored (or rejected by the horde after it has been in the queue). check adds what's wrong with
+# the values themselves, like dimensions which aren't a multiple of 64, to the list of problems it gets.
+# Any problem stops the run, unless strict is off (--skip_checks), for what the horde accepts but we don't know about yet
+class RequestSchema(object):
+    def __init__(self, kind, attributes, params_attr, params, submit, check):
+        self.kind = kind
+        self.attributes = attributes
+        self.params_attr = params_attr
+        self.params = params
+        self.submit = submit
+        self.check = check
+
+    # Reads the yml config file, if there is one, into the request data. It's only read once per run,
+    # and the batch entries are put on top of the request data it produces
+    def load(self, request_data, config_file, strict=True):
+        if not os.path.exists(config_file):
+            return(request_data)
+        import yaml
+        with open(config_file, "rt", encoding="utf-8", errors="ignore") as configfile:
+            config = yaml.safe_load(configfile)
+        if config is None:
+            return(request_data)
+        if type(config) is not dict:
+            logger.error(f"{config_file} has to be a mapping of request data keys. Got: {config!r}")
+            sys.exit(1)
+        self.report(self.check_keys(config), config_file, strict)
+        for key, value in config.items():
+            setattr(request_data, key, value)
+        return(request_data)
+
+    def check_keys(self, config):
+        problems = []
+        for key, value in config.items():
+            if key not in self.attributes:
+                problems.append(f"Unknown key '{key}'{_suggest(key, list(self.attributes))}")
+            elif key == self.params_attr:
+                problems += self.check_mapping(key, value, self.params)
+            elif key == "submit_dict":
+                problems += self.check_mapping(key, value, self.submit)
+            elif not self.is_type(value, self.attributes[key]):
+                problems.append(f"{key} has to be {self.describe(self.attributes[key])}. Got: {value!r}")
+        return(problems)
+
+    def check_mapping(self, name, mapping, schema):
+        if type(mapping) is not dict:
+            return([f"{name} has to be a mapping. Got: {mapping!r}"])
+        problems = []
+        for key, value in mapping.items():
+            if key not in schema:
+                problems.append(f"Unknown key '{name}.{key}'{_suggest(key, list(schema))}")
+            elif not self.is_type(value, schema[key]):
+                problems.append(f"{name}.{key} has to be {self.describe(schema[key])}. Got: {value!r}")
+        return(problems)
+
+    # Checks the complete request data, once the args (or a batch entry) have been put on top of the config.
+    # source tells where the request data came from, for the error
+    def validate(self, request_data, source=None, strict=True):
+        problems = self.check_keys({key: getattr(request_data, key) for key in self.attributes})
+        # The values can only be checked once they have the right types
+        if not problems:
+            self.check(request_data, problems)
+        self.report(problems, source, strict)
+        return(request_data)
+
+    @staticmethod
+    def report(problems, source, strict):
+        if not problems:
+            return
+        location = f" in {source}" if source else ""
+        if not strict:
+            for problem in problems:
+                logger.warning(f"Sending the request anyway, but{location}: {problem}")
+            return
+        logger.error(f"Invalid request data{location}:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+
+    @staticmethod
+    def is_type(value, types):
+        if type(types) is not tuple:
+            types = (types,)
+        # bool is an int to python, but not to the horde
+        if type(value) is bool:
+            return(bool in types)
+        return(isinstance(value, types))
+
+    @staticmethod
+    def describe(types):
+        if type(types) is not tuple:
+            types = (types,)
+        return(" or ".join("null" if value_type is NONE else value_type.__name__ for value_type in types))
+
+
+IMAGE_SCHEMA = RequestSchema(
+    "image",
+    attributes = {
+        "client_agent": str,
+        "api_key": str,
+        "filename": str,
+        "imgen_params": dict,
+        "submit_dict": dict,
+        "source_image": (str, NONE),
+        "source_processing": str,
+        "source_mask": (str, NONE),
+        "keep_source_size": bool,
+        "priority": NUMBER,
+    },
+    params_attr = "imgen_params",
+    params = {
+        "n": int,
+        "width": int,
+        "height": int,
+        "steps": int,
+        "sampler_name": str,
+        "cfg_scale": NUMBER,
+        "denoising_strength": NUMBER,
+        "hires_fix_denoising_strength": NUMBER,
+        "seed": (str, int),
+        "seed_variation": int,
+        "post_processing": list,
+        "karras": bool,
+        "tiling": bool,
+        "hires_fix": bool,
+        "clip_skip": int,
+        "control_type": str,
+        "image_is_control": bool,
+        "return_control_map": bool,
+        "facefixer_strength": NUMBER,
+        "loras": list,
+        "tis": list,
+        "special": dict,
+        "workflow": str,
+        "transparent": bool,
+        "extra_texts": list,
+    },
+    submit = dict(GENERATION_SUBMIT, **{
+        "nsfw": bool,
+        "censor_nsfw": bool,
+        "r2": bool,
+        "shared": bool,
+        "replacement_filter": bool,
+        "extra_source_images": list,
+    }),
+    check = check_image_request,
+)
+
+TEXT_SCHEMA = RequestSchema(
+    "text",
+    attributes = {
+        "client_agent": str,
+        "api_key": str,
+        "txtgen_params": dict,
+        "submit_dict": dict,
+        "priority": NUMBER,
+    },
+    params_attr = "txtgen_params",
+    params = {
+        "n": int,
+        "max_context_length": int,
+        "max_length": int,
+        "rep_pen": NUMBER,
+        "rep_pen_range": int,
+        "rep_pen_slope": NUMBER,
+        "temperature": NUMBER,
+        "tfs": NUMBER,
+        "top_a": NUMBER,
+        "top_k": int,
+        "top_p": NUMBER,
+        "typical": NUMBER,
+        "min_p": NUMBER,
+        "smoothing_factor": NUMBER,
+        "dynatemp_range": NUMBER,
+        "dynatemp_exponent": NUMBER,
+        "sampler_order": list,
+        "stop_sequence": list,
+        "singleline": bool,
+        "use_default_badwordsids": bool,
+        "frmtadsnsp": bool,
+        "frmtrmblln": bool,
+        "frmtrmspch": bool,
+        "frmttriminc": bool,
+    },
+    submit = dict(GENERATION_SUBMIT, **{
+        "softprompt": str,
+    }),
+    check = check_text_request,
+)
+
+INTERROGATE_SCHEMA = RequestSchema(
+    "interrogate",
+    attributes = {
+        "client_agent": str,
+        "api_key": str,
+        "filename": str,
+        "submit_dict": dict,
+        "source_image": (str, NONE),
+    },
+    params_attr = None,
+    params = {},
+    submit = dict(COMMON_SUBMIT, **{
+        "forms": list,
+    }),
+    check = check_interrogate_request,
+)
@@ -0,0 +1,569 @@
+import argparse, asyncio, hmac, json, os, re, secrets, socket
+
+from cli_logger import logger, set_logger_verbosity, quiesce_logger, enable_json_log
+from cli_image_cache import get_cache_dir
+from cli_horde_client import HordeClient, HordeJob, JobTimer, run_async, add_client_args
+from cli_scheduler import KudosScheduler
+
+# A resident process which keeps one HordeClient (its connection pools, caches, journal and retry budget)
+# for all the CLI runs on this machine. The CLIs find it on a local socket and hand their jobs to it
+# instead of talking to the horde themselves, so short runs don't pay for their own connections,
+# and the --concurrency of the daemon limits how many jobs all of them keep in the horde together.
+#
+# The protocol is one json object per line. Every request has an "id" and an "op", and gets a response with the same id
+# and "ok": true or false (with an "error"). A wait with "checks": true also gets a line with a "check" for every status check.
+# Only the user can open the unix socket. A TCP port is open to everyone, so the daemon writes a token to a file only the user
+# can read, and the first request on a TCP connection has to be an auth with it. Anything else closes the connection.
+#   auth     token                           -> (only on TCP, and only as the first request)
+#   ping                                     -> version, jobs, horde
+#   submit   kind, submit_dict, headers, label, keep, fetch, horde -> job (refused when horde isn't the horde of the daemon)
+#   status   job                             -> state, horde_id, last_check, error
+#   wait     job, checks                     -> state, horde_id, results, error, cached, checks, kudos, queue_wait, generation_time
+#   cancel   job                             -> state
+#   fetch    job, url, filename              -> size (saves one of the result URLs of the job to an absolute filename)
+#   saved    job, complete                   -> (the caller is done with the job, and saved all of it unless complete is false. Only needed when it was submitted with fetch)
+#   user     headers                         -> user (what the horde knows about the user of the api key in headers, or null)
+#   shutdown                                 -> (stops the daemon)
+# Jobs submitted without keep are cancelled when the connection which submitted them is closed.
+DAEMON_VERSION = 1
+# Finished jobs stay around this long, so that their status can still be asked for
+FINISHED_JOB_TTL = 600
+# Submits carry whole images in base64, so lines can be long
+LINE_LIMIT = 2**28
+TCP_ADDRESS_REGEX = re.compile(r"^([\w.-]+):(\d+)$")
+# What a client of our own does with these can't be handed to the daemon, which has a journal, result cache,
+# metrics and kudos budget of its own (if any). A run which asks for them never uses the daemon
+LOCAL_ONLY_ARGS = ["journal", "resume", "result_cache", "metrics_jsonl", "metrics_prom", "max_kudos"]
+
+
+class DaemonError(Exception):
+    pass
+
+
+def get_daemon_address():
+    address = os.environ.get("HORDE_CLI_DAEMON")
+    if address:
+        return(address)
+    if hasattr(socket, "AF_UNIX"):
+        return(os.path.join(get_cache_dir("daemon"), "daemon.sock"))
+    return("127.0.0.1:7002")
+
+
+# Where a daemon on a TCP address keeps the token its callers have to send
+def get_token_file(address):
+    return(os.path.join(get_cache_dir("daemon"), f"{address.replace(':', '-')}.token"))
+
+
+def read_token(address):
+    token_file = get_token_file(address)
+    try:
+        with open(token_file, "rt", encoding="utf-8") as handler:
+            return(handler.read().strip())
+    except OSError as err:
+        raise DaemonError(f"Could not read the token of the daemon from {token_file}: {err}")
+
+
+def write_token(address):
+    token = secrets.token_hex(32)
+    token_file = get_token_file(address)
+    os.makedirs(os.path.dirname(token_file), mode=0o700, exist_ok=True)
+    handle = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # The mode of os.open only applies to a new file, not one left behind by an earlier daemon
+    os.chmod(token_file, 0o600)
+    with os.fdopen(handle, "wt", encoding="utf-8") as handler:
+        handler.write(token)
+    return(token)
+
+
+def is_same_horde(horde_url, other_url):
+    return(horde_url.rstrip("/") == other_url.rstrip("/"))
+
+
+async def open_connection(address):
+    tcp_match = TCP_ADDRESS_REGEX.match(address)
+    if tcp_match:
+        return(await asyncio.open_connection(tcp_match.group(1), int(tcp_match.group(2)), limit=LINE_LIMIT))
+    return(await asyncio.open_unix_connection(address, limit=LINE_LIMIT))
+
+
+async def send_message(writer, message):
+    writer.write((json.dumps(message) + "\n").encode("utf-8"))
+    await writer.drain()
+
+
+class DaemonJob(object):
+    def __init__(self, job_id, job, fetch):
+        self.job_id = job_id
+        self.job = job
+        self.fetch = fetch
+        self.task = None
+        self.finished = asyncio.Event()
+        # Set by the caller once it has fetched what it needs. Only then is the job stored in the result cache and the journal
+        self.saved = asyncio.Event()
+        # Whether the caller managed to save all the results
+        self.complete = True
+        self.listeners = []
+
+
+class HordeDaemon(object):
+    def __init__(self, client, address, concurrency=20):
+        self.client = client
+        self.address = address
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.jobs = {}
+        self.next_id = 0
+        self.server = None
+        self.stopped = asyncio.Event()
+        # What the callers have to send first on a TCP connection. None on a unix socket
+        self.token = None
+
+    async def serve(self):
+        tcp_match = TCP_ADDRESS_REGEX.match(self.address)
+        if tcp_match:
+            self.server = await asyncio.start_server(self.handle_connection, tcp_match.group(1), int(tcp_match.group(2)), limit=LINE_LIMIT)
+            # Only written once the port is ours, so that it never replaces the token of a daemon already running on it
+            self.token = write_token(self.address)
+        else:
+            os.makedirs(os.path.dirname(self.address), mode=0o700, exist_ok=True)
+            if os.path.exists(self.address):
+                try:
+                    reader, writer = await open_connection(self.address)
+                    writer.close()
+                except OSError:
+                    # Left behind by a daemon which didn't get to clean up
+                    os.remove(self.address)
+                else:
+                    raise DaemonError(f"A horde daemon is already running on {self.address}")
+            self.server = await asyncio.start_unix_server(self.handle_connection, self.address, limit=LINE_LIMIT)
+            # Rather than whatever the umask allows, as anyone who can open the socket can use the api keys sent through it
+            os.chmod(self.address, 0o600)
+        logger.message(f"Horde daemon listening on {self.address}")
+        await self.stopped.wait()
+
+    async def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        tasks = [record.task for record in self.jobs.values() if record.task is not None]
+        for record in self.jobs.values():
+            record.saved.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if not TCP_ADDRESS_REGEX.match(self.address) and os.path.exists(self.address):
+            os.remove(self.address)
+        if self.token is not None and os.path.exists(get_token_file(self.address)):
+            os.remove(get_token_file(self.address))
+
+    async def handle_connection(self, reader, writer):
+        session = []
+        tasks = set()
+        write_lock = asyncio.Lock()
+        authenticated = self.token is None
+
+        async def reply(message):
+            async with write_lock:
+                await send_message(writer, message)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if not authenticated:
+                    request_id = request.get("id") if type(request) is dict else None
+                    if not self.is_authentic(request):
+                        logger.warning("Dropping a daemon connection which didn't send the token")
+                        await reply({"id": request_id, "ok": False, "error": "The first request on a TCP connection has to be an auth with the token of the daemon"})
+                        break
+                    authenticated = True
+                    await reply({"id": request_id, "ok": True})
+                    continue
+                task = asyncio.create_task(self.handle_request(request, session, reply))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as err:
+            logger.warning(f"Dropping a daemon connection: {err}")
+        except asyncio.CancelledError:
+            # The daemon is shutting down. asyncio would complain about connection tasks ending cancelled
+            pass
+        finally:
+            # The caller went away, so nobody is left to use the results of the jobs it was running
+            for job_id in session:
+                record = self.jobs.get(job_id)
+                if record is None:
+                    continue
+                if not record.task.done():
+                    record.task.cancel()
+                record.saved.set()
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def is_authentic(self, request):
+        if type(request) is not dict or request.get("op") != "auth":
+            return(False)
+        return(hmac.compare_digest(str(request.get("token")).encode("utf-8"), self.token.encode("utf-8")))
+
+    async def handle_request(self, request, session, reply):
+        request_id = request.get("id")
+        handler = getattr(self, f"op_{request.get('op')}", None)
+        try:
+            if handler is None:
+                raise DaemonError(f"Unknown op '{request.get('op')}'")
+            result = await handler(request, session, lambda message: reply({"id": request_id, **message}))
+            response = {"id": request_id, "ok": True, **result}
+        except Exception as err:
+            # Whatever went wrong goes back to the caller, which would otherwise wait for its answer forever
+            response = {"id": request_id, "ok": False, "error": str(err)}
+        try:
+            await reply(response)
+        except ConnectionError:
+            pass
+
+    def get_record(self, request):
+        record = self.jobs.get(request.get("job"))
+        if record is None:
+            raise DaemonError(f"Unknown job {request.get('job')}")
+        return(record)
+
+    def forget(self, job_id):
+        self.jobs.pop(job_id, None)
+
+    async def op_ping(self, request, session, notify):
+        return({"version": DAEMON_VERSION, "jobs": len(self.jobs), "horde": self.client.horde_url})
+
+    async def op_submit(self, request, session, notify):
+        if request.get("horde") is not None and not is_same_horde(request["horde"], self.client.horde_url):
+            raise DaemonError(f"This daemon sends its jobs to {self.client.horde_url}, not {request['horde']}")
+        job = HordeJob(request["kind"], request["submit_dict"], request.get("headers", {}), request.get("label"))
+        self.next_id += 1
+        job_id = str(self.next_id)
+        record = DaemonJob(job_id, job, request.get("fetch", False))
+
+        async def on_done(job):
+            record.finished.set()
+            if record.fetch:
+                await record.saved.wait()
+            return(record.complete)
+
+        def on_task_done(task):
+            # A job cancelled in the middle of a request ends without getting to on_done
+            record.finished.set()
+            asyncio.get_running_loop().call_later(FINISHED_JOB_TTL, self.forget, job_id)
+
+        def on_check(job, chk_results):
+            for listener in record.listeners:
+                listener(chk_results)
+
+        self.jobs[job_id] = record
+        record.task = asyncio.create_task(self.client.run_queued(job, self.semaphore, on_done, on_check))
+        record.task.add_done_callback(on_task_done)
+        if not request.get("keep"):
+            session.append(job_id)
+        logger.info(f"Accepted {job.kind} job {job_id}")
+        return({"job": job_id})
+
+    def get_status(self, record):
+        return({
+            "state": record.job.state,
+            "horde_id": record.job.id,
+            "last_check": record.job.last_check,
+            "error": record.job.error,
+        })
+
+    async def op_status(self, request, session, notify):
+        return(self.get_status(self.get_record(request)))
+
+    async def op_wait(self, request, session, notify):
+        record = self.get_record(request)
+        listener = None
+        if request.get("checks"):
+            def listener(chk_results):
+                asyncio.create_task(notify({"check": chk_results, "horde_id": record.job.id}))
+            record.listeners.append(listener)
+        try:
+            await record.finished.wait()
+        finally:
+            if listener is not None:
+                record.listeners.remove(listener)
+        job = record.job
+        result = self.get_status(record)
+        result.update({
+            "results": job.results,
+            "cached": job.cached,
+            "checks": job.checks,
+            "kudos": job.kudos,
+            "queue_wait": job.timer.queue_wait,
+            "generation_time": job.timer.generation_time,
+        })
+        return(result)
+
+    async def op_cancel(self, request, session, notify):
+        record = self.get_record(request)
+        if not record.task.done():
+            record.task.cancel()
+        return({"state": record.job.state})
+
+    # Only the results of the job can be fetched, so that the daemon can't be made to download whatever a caller wants
+    async def op_fetch(self, request, session, notify):
+        record = self.get_record(request)
+        if request["url"] not in record.job.get_result_urls():
+            raise DaemonError(f"{request['url']} is not a result of job {record.job_id}")
+        if not os.path.isabs(request["filename"]):
+            raise DaemonError("The filename to fetch to has to be absolute")
+        return({"size": await self.client.fetch_result(record.job, request["url"], request["filename"])})
+
+    async def op_saved(self, request, session, notify):
+        record = self.get_record(request)
+        record.complete = request.get("complete", True)
+        record.saved.set()
+        return({})
+
+    async def op_user(self, request, session, notify):
+        return({"user": await self.client.find_user(request.get("headers", {}))})
+
+    async def op_shutdown(self, request, session, notify):
+        logger.message("Shutting down the horde daemon")
+        self.stopped.set()
+        return({})
+
+
+# Talks to a running daemon through a single connection, with the same interface the CLIs use on a HordeClient.
+# With a horde_url, it refuses to connect to a daemon which sends its jobs to another horde
+class DaemonClient(object):
+    def __init__(self, address, scheduler=None, horde_url=None):
+        self.address = address
+        self.horde_url = horde_url
+        # Only orders the batches. The daemon keeps the kudos budget for all of its callers
+        self.scheduler = scheduler or KudosScheduler()
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.write_lock = asyncio.Lock()
+        self.requests = {}
+        self.next_id = 0
+        self.daemon_jobs = {}
+        self.interrupted = False
+        self.downloaded_bytes = 0
+
+    async def connect(self):
+        self.reader, self.writer = await open_connection(self.address)
+        self.reader_task = asyncio.create_task(self.read_responses())
+        try:
+            if TCP_ADDRESS_REGEX.match(self.address):
+                await self.request("auth", token=read_token(self.address))
+            pong = await self.request("ping")
+            if self.horde_url is not None and not is_same_horde(pong["horde"], self.horde_url):
+                raise DaemonError(f"The daemon sends its jobs to {pong['horde']}, not {self.horde_url}")
+        except DaemonError:
+            await self.close()
+            raise
+        return(self)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+
+    async def __aenter__(self):
+        return(await self.connect())
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def read_responses(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                future, on_message = self.requests.get(message.get("id"), (None, None))
+                if future is None:
+                    continue
+                if "ok" not in message:
+                    if on_message is not None:
+                        on_message(message)
+                    continue
+                del self.requests[message["id"]]
+                if future.done():
+                    # Whoever asked has been cancelled in the meantime
+                    continue
+                if message["ok"]:
+                    future.set_result(message)
+                else:
+                    future.set_exception(DaemonError(message["error"]))
+        finally:
+            for future, on_message in self.requests.values():
+                if not future.done():
+                    future.set_exception(DaemonError("The daemon closed the connection"))
+
+    async def request(self, op, on_message=None, **params):
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = (future, on_message)
+        async with self.write_lock:
+            await send_message(self.writer, {"id": request_id, "op": op, **params})
+        return(await future)
+
+    def apply_result(self, job, result):
+        job.state = result["state"]
+        job.id = result["horde_id"]
+        job.results = result["results"]
+        job.error = result["error"]
+        job.cached = result["cached"]
+        job.checks = result["checks"]
+        job.kudos = result["kudos"]
+        # The daemon timed the job, so we rebuild our timer from its durations
+        if result["queue_wait"] is not None:
+            job.timer.started = job.timer.submitted + result["queue_wait"]
+        if result["generation_time"] is not None:
+            job.timer.finished = job.timer.started + result["generation_time"]
+
+    async def run_job(self, job, on_check=None):
+        job.timer = JobTimer()
+        submitted = await self.request("submit", kind=job.kind, submit_dict=job.submit_dict, headers=job.headers, label=job.label, fetch=True, horde=self.horde_url)
+        daemon_id = submitted["job"]
+        self.daemon_jobs[job] = daemon_id
+        job.state = "submitted"
+
+        def on_message(message):
+            job.id = message["horde_id"]
+            job.last_check = message["check"]
+            if on_check is not None:
+                on_check(job, message["check"])
+
+        try:
+            # The checks keep job.last_check up to date for the dashboard, as with a HordeClient
+            result = await self.request("wait", on_message, job=daemon_id, checks=True)
+        except asyncio.CancelledError:
+            # The daemon stops the job in the horde and still gives us whatever it generated
+            await self.request("cancel", job=daemon_id)
+            result = await self.request("wait", job=daemon_id)
+        self.apply_result(job, result)
+        return(job)
+
+    async def run_queued(self, job, semaphore, on_done=None, on_check=None):
+        try:
+            async with semaphore:
+                await self.run_job(job, on_check)
+        except asyncio.CancelledError:
+            if job.state != "pending":
+                raise
+            job.state = "cancelled"
+        except DaemonError as err:
+            logger.error(f"Job {job.name} failed: {err}")
+            job.state = "error"
+            job.error = str(err)
+        saved = None
+        if on_done is not None:
+            try:
+                saved = await on_done(job)
+            except Exception as err:
+                logger.error(f"Saving the results of job {job.name} failed: {err}")
+                saved = False
+        if job in self.daemon_jobs:
+            try:
+                await self.request("saved", job=self.daemon_jobs.pop(job), complete=saved is not False)
+            except DaemonError as err:
+                logger.warning(f"Could not tell the daemon job {job.name} is saved: {err}")
+        return(job)
+
+    async def run_jobs(self, jobs, concurrency, on_done=None, on_check=None):
+        scheduled = jobs
+        if len(jobs) > 1:
+            user = (await self.request("user", headers=jobs[0].headers))["user"]
+            scheduled, concurrency = self.scheduler.plan(jobs, concurrency, user)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        tasks = [asyncio.create_task(self.run_queued(job, semaphore, on_done, on_check)) for job in scheduled]
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            self.interrupted = True
+            logger.warning("Interrupted. All in-flight jobs have been stopped")
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return(jobs)
+
+    async def fetch_result(self, job, url, filename):
+        fetched = await self.request("fetch", job=self.daemon_jobs[job], url=url, filename=os.path.abspath(filename))
+        self.downloaded_bytes += fetched["size"]
+        return(fetched["size"])
+
+
+# Hands the jobs to the daemon when one is running, or runs them with a HordeClient of our own otherwise.
+# Used as `async with AutoClient(args) as client:` in place of HordeClient.from_args(args)
+class AutoClient(object):
+    def __init__(self, args):
+        self.args = args
+        self.client = None
+
+    async def __aenter__(self):
+        local_args = [f"--{arg}" for arg in LOCAL_ONLY_ARGS if getattr(self.args, arg) is not None and getattr(self.args, arg) is not False]
+        if local_args and not self.args.no_daemon:
+            logger.info(f"Not using the horde daemon, as {', '.join(local_args)} can only be used by a client of our own")
+        elif not self.args.no_daemon:
+            address = get_daemon_address()
+            if TCP_ADDRESS_REGEX.match(address) or os.path.exists(address):
+                try:
+                    self.client = await DaemonClient(address, KudosScheduler(self.args.schedule), self.args.horde).connect()
+                    logger.info(f"Using the horde daemon at {address}")
+                    return(self.client)
+                except (OSError, DaemonError) as err:
+                    logger.info(f"Not using the horde daemon at {address}: {err}")
+        self.client = HordeClient.from_args(self.args)
+        return(await self.client.__aenter__())
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return(await self.client.__aexit__(exc_type, exc, tb))
+
+
+def add_args(arg_parser):
+    arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
+    arg_parser.add_argument('--socket', action="store", required=False, type=str, help="The unix socket path, or host:port, to listen on. Defaults to the HORDE_CLI_DAEMON environment variable, or a socket in the cache directory")
+    arg_parser.add_argument('--concurrency', action="store", required=False, type=int, default=20, help="The maximum amount of jobs of all callers to keep in flight on the horde at the same time")
+    arg_parser.add_argument('--stop', action="store_true", default=False, required=False, help="Stop the running daemon instead of starting one")
+    arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
+    arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
+    add_client_args(arg_parser)
+
+
+async def run_daemon(args, address):
+    async with HordeClient.from_args(args) as client:
+        daemon = HordeDaemon(client, address, args.concurrency)
+        try:
+            await daemon.serve()
+        except DaemonError as err:
+            logger.error(err)
+            return
+        finally:
+            await daemon.close()
+
+
+async def stop_daemon(address):
+    async with DaemonClient(address) as client:
+        await client.request("shutdown")
+
+
+def main(args):
+    set_logger_verbosity(args.verbosity)
+    quiesce_logger(args.quiet)
+    enable_json_log(args.log_jsonl)
+    address = args.socket or get_daemon_address()
+    if args.stop:
+        try:
+            run_async(stop_daemon(address))
+        except (OSError, DaemonError) as err:
+            logger.error(f"No horde daemon is running at {address}: {err}")
+        return
+    run_async(run_daemon(args, address))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    add_args(arg_parser)
+    main(arg_parser.parse_args())
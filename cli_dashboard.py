@@ -0,0 +1,110 @@
+import asyncio, shutil, sys, time
+from collections import Counter, deque
+
+from cli_logger import logger, set_status_line, clear_status_line
+
+# The states a job can end in, in the order the dashboard shows them
+FINAL_STATES = ["done", "faulted", "cancelled", "error", "over_budget", "skipped", "detached"]
+# How many seconds of downloads the bandwidth is averaged over
+BANDWIDTH_WINDOW = 5
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return(f"{seconds}s")
+    if seconds < 3600:
+        return(f"{seconds // 60}m{seconds % 60:02d}s")
+    return(f"{seconds // 3600}h{seconds % 3600 // 60:02d}m")
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return(f"{size:.1f} {unit}")
+        size /= 1024
+    return(f"{size:.1f} GB")
+
+
+# A live view of all the jobs of a batch, built from the state and the last status check of each job.
+# On a terminal it's a status line at the bottom which is redrawn twice a second, with the log scrolling above it.
+# Otherwise (like when the output goes to a file) a summary line is written every `interval` seconds instead.
+# Used as `async with Dashboard(client, jobs):` around the run of the jobs
+class Dashboard(object):
+    def __init__(self, client, jobs, interval=10):
+        self.client = client
+        self.jobs = jobs
+        self.interval = interval
+        self.live = sys.stderr.isatty()
+        self.start = None
+        self.task = None
+        # (time, downloaded bytes) over the last BANDWIDTH_WINDOW seconds
+        self.downloads = deque()
+
+    async def __aenter__(self):
+        self.start = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        if self.live:
+            clear_status_line()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(0.5 if self.live else self.interval)
+            line = self.render()
+            if self.live:
+                # A line which wraps can't be redrawn in place
+                set_status_line(line[:shutil.get_terminal_size().columns - 1])
+            else:
+                logger.message(line)
+
+    def get_bandwidth(self):
+        now = time.monotonic()
+        self.downloads.append((now, self.client.downloaded_bytes))
+        while now - self.downloads[0][0] > BANDWIDTH_WINDOW:
+            self.downloads.popleft()
+        elapsed = now - self.downloads[0][0]
+        if elapsed <= 0:
+            return(0)
+        return((self.downloads[-1][1] - self.downloads[0][1]) / elapsed)
+
+    def render(self):
+        states = Counter()
+        queue_positions = []
+        wait_times = []
+        for job in self.jobs:
+            if job.state != "submitted":
+                states[job.state] += 1
+                continue
+            chk_results = job.last_check or {}
+            # Interrogations only tell us their state
+            if chk_results.get("processing") or chk_results.get("state") == "processing":
+                states["processing"] += 1
+            else:
+                states["waiting"] += 1
+                if chk_results.get("queue_position") is not None:
+                    queue_positions.append(chk_results["queue_position"])
+            if chk_results.get("wait_time") is not None:
+                wait_times.append(chk_results["wait_time"])
+        elapsed = time.monotonic() - self.start
+        throughput = states["done"] / elapsed if elapsed > 0 else 0
+        finished = sum(states[state] for state in FINAL_STATES)
+        parts = [", ".join([f"{states['done']}/{len(self.jobs)} done"] + [f"{states[state]} {state}" for state in FINAL_STATES[1:] if states[state]])]
+        in_flight = f"{states['pending']} pending, {states['waiting']} waiting, {states['processing']} processing"
+        if queue_positions:
+            in_flight += f" (queue {min(queue_positions)}-{max(queue_positions)})"
+        parts.append(in_flight)
+        parts.append(f"{throughput * 60:.1f} jobs/min")
+        remaining = len(self.jobs) - finished
+        if remaining > 0 and (wait_times or throughput > 0):
+            # The horde knows how long the jobs it has will take. The rest start as slots free up, at the pace we've seen so far
+            eta = max(wait_times, default=0)
+            if throughput > 0:
+                eta = max(eta, remaining / throughput)
+            parts.append(f"ETA {format_duration(eta)}")
+        parts.append(f"{format_size(self.get_bandwidth())}/s")
+        return(" | ".join(parts))
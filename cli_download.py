@@ -0,0 +1,89 @@
+import hashlib, os, re
+import httpx
+
+from cli_polling import get_retry_after
+from cli_retry import RetryPolicy, classify_error
+
+CHUNK_SIZE = 64 * 1024
+# R2 and S3 send the MD5 of the object as its ETag, unless it was a multipart upload
+MD5_ETAG_REGEX = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as handler:
+        for chunk in iter(lambda: handler.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return(md5.hexdigest())
+
+
+# Streams a single response into the partial file, appending to it when the server accepted our Range.
+# Returns the size the whole file is expected to have (if known) and its ETag
+async def _stream_to_part(http, url, part_filename):
+    headers = {}
+    existing_size = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if existing_size > 0:
+        headers["Range"] = f"bytes={existing_size}-"
+    async with http.stream("GET", url, headers=headers) as response:
+        if response.status_code == 416:
+            # We already have everything the server has
+            return(existing_size, response.headers.get("ETag"))
+        response.raise_for_status()
+        if response.status_code == 206:
+            mode = 'ab'
+            total_size = existing_size + int(response.headers["Content-Length"]) if "Content-Length" in response.headers else None
+        else:
+            # The server ignored our range, so we have to start over
+            mode = 'wb'
+            total_size = int(response.headers["Content-Length"]) if "Content-Length" in response.headers else None
+        with open(part_filename, mode) as handler:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                handler.write(chunk)
+        # The Content-Length and the ETag of a compressed response are about the compressed body,
+        # while what we wrote is decompressed, so there's nothing to check it against
+        if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+            return(None, None)
+        return(total_size, response.headers.get("ETag"))
+
+
+# Downloads a URL straight to disk without holding it all in memory.
+# The data goes to a .part file first and is only renamed to the final filename once its size
+# (and its MD5, when the ETag provides one) has been validated. A broken download is resumed from where it stopped.
+async def download_to_file(http, url, filename, retry_policy=None, job_metrics=None):
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_attempts=4)
+    part_filename = f"{filename}.part"
+    if os.path.exists(part_filename):
+        os.remove(part_filename)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            total_size, etag = await _stream_to_part(http, url, part_filename)
+            written_size = os.path.getsize(part_filename)
+            if total_size is not None and written_size != total_size:
+                raise DownloadError(f"Expected {total_size} bytes but received {written_size}")
+            etag_match = MD5_ETAG_REGEX.match(etag or '')
+            if etag_match and _file_md5(part_filename) != etag_match.group(1):
+                # A corrupt file can't be resumed
+                os.remove(part_filename)
+                raise DownloadError("Checksum does not match the ETag")
+            os.replace(part_filename, filename)
+            return(written_size)
+        except (httpx.TransportError, httpx.HTTPStatusError, DownloadError) as err:
+            retry_after = None
+            if isinstance(err, DownloadError):
+                error_class = "corrupt"
+            elif isinstance(err, httpx.HTTPStatusError):
+                error_class = classify_error(response=err.response)
+                retry_after = get_retry_after(err.response)
+            else:
+                error_class = classify_error(err)
+            if error_class is None or not await retry_policy.backoff(attempt, error_class, f"Downloading {url} failed with {err}", job_metrics, retry_after):
+                if os.path.exists(part_filename):
+                    os.remove(part_filename)
+                raise
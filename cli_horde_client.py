@@ -0,0 +1,538 @@
+import asyncio, importlib.util, os, time
+import httpx
+
+from cli_logger import logger, enable_metrics
+from cli_metrics import JobMetrics, metrics
+from cli_polling import PollScheduler, ProgressLog
+from cli_retry import RetryPolicy, RetryBudget, CircuitBreaker
+from cli_scheduler import KudosScheduler, SCHEDULE_ORDERS
+from cli_download import download_to_file
+from cli_result_cache import ResultCache
+from cli_journal import JobJournal
+from cli_image_cache import get_cache_dir
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2]). We only look for it here,
+# httpx imports it once a client is created
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# The horde endpoints each kind of job goes through. The text horde has no lightweight check endpoint
+JOB_ENDPOINTS = {
+    "image": {
+        "submit": "/api/v2/generate/async",
+        "check": "/api/v2/generate/check/{}",
+        "status": "/api/v2/generate/status/{}",
+    },
+    "text": {
+        "submit": "/api/v2/generate/text/async",
+        "check": "/api/v2/generate/text/status/{}",
+        "status": "/api/v2/generate/text/status/{}",
+    },
+    "interrogate": {
+        "submit": "/api/v2/interrogate/async",
+        "check": "/api/v2/interrogate/status/{}",
+        "status": "/api/v2/interrogate/status/{}",
+    },
+}
+
+
+# Tracks how long a single job spent waiting in the horde queue and generating
+class JobTimer(object):
+    def __init__(self):
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+
+    def record_check(self, chk_results):
+        # The first time we see the job being worked on, it has left the queue
+        if self.started is None:
+            if chk_results.get("processing", 0) > 0 or chk_results.get("finished", 0) > 0 or chk_results.get("done"):
+                self.started = time.monotonic()
+
+    def finish(self):
+        self.finished = time.monotonic()
+        if self.started is None:
+            self.started = self.finished
+
+    @property
+    def queue_wait(self):
+        if self.started is None:
+            return(None)
+        return(self.started - self.submitted)
+
+    @property
+    def generation_time(self):
+        if self.finished is None:
+            return(None)
+        return(self.finished - self.started)
+
+
+class HordeJob(object):
+    # request_data is whatever the CLI needs to handle the results later. The client never touches it
+    def __init__(self, kind, submit_dict, headers, label=None, request_data=None, job_metrics=None, priority=0):
+        if kind not in JOB_ENDPOINTS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        self.kind = kind
+        self.submit_dict = submit_dict
+        self.headers = headers
+        self.label = label
+        self.request_data = request_data
+        # Jobs with a higher priority are submitted first when the batch is scheduled by priority
+        self.priority = priority
+        self.id = None
+        # One of pending, submitted, done, faulted, cancelled, error, over_budget (not submitted because of --max_kudos),
+        # skipped (already saved by a previous run) or detached (left in the horde to be resumed)
+        self.state = "pending"
+        self.submit_results = None
+        self.last_check = None
+        self.results = None
+        self.error = None
+        self.timer = JobTimer()
+        self.metrics = job_metrics or JobMetrics()
+        # What the horde charged for the job, or our estimate until it tells us
+        self.kudos = 0
+        # How many status checks this job took
+        self.checks = 0
+        # Whether the results came from the local result cache instead of the horde
+        self.cached = False
+        # The bytes of every result URL, when we need to keep them for the result cache
+        self.blobs = {}
+        # Whether we picked this job up again from the journal of a previous run
+        self.reattached = False
+        self._journal_key = None
+
+    # Identifies the job across runs, so that a resumed batch can find what it already did
+    @property
+    def journal_key(self):
+        if self._journal_key is None:
+            self._journal_key = ResultCache.get_key(self.kind, {"label": self.label, "submit_dict": self.submit_dict})
+        return(self._journal_key)
+
+    # What the log calls the job: its label in a batch, otherwise its horde id, or its kind before it has one
+    @property
+    def name(self):
+        if self.label is not None:
+            return(str(self.label))
+        if self.id is not None:
+            return(self.id)
+        return(self.kind)
+
+    def get_endpoint(self, endpoint):
+        return(JOB_ENDPOINTS[self.kind][endpoint].format(self.id))
+
+    def is_check_done(self, chk_results):
+        if self.kind == "interrogate":
+            return(chk_results['state'] in ["done", "faulted"])
+        return(chk_results['done'])
+
+    def is_faulted(self, results_json):
+        if self.kind == "interrogate":
+            return(results_json['state'] == "faulted")
+        return(results_json['faulted'])
+
+    # The results which the horde only sent as a URL to download
+    def get_result_urls(self):
+        if self.results is None:
+            return([])
+        if self.kind == "image":
+            return([gen["img"] for gen in self.results.get("generations", []) if gen["img"].startswith("http")])
+        if self.kind == "interrogate":
+            return([
+                form["result"][form["form"]] for form in self.results.get("forms", [])
+                if form["state"] == "done" and type(form["result"].get(form["form"])) is str and form["result"][form["form"]].startswith("http")
+            ])
+        return([])
+
+    # Every single check only goes to the debug log. The client logs a summary of all jobs in flight instead
+    def log_check(self, chk_results):
+        if self.kind == "interrogate":
+            logger.debug(
+                [
+                    {
+                        'form': f['form'],
+                        'state': f['state'],
+                    } for f in chk_results['forms']
+                ]
+            )
+        else:
+            logger.debug(chk_results)
+
+
+def add_client_args(arg_parser):
+    arg_parser.add_argument('--timeout', action="store", required=False, type=float, default=30, help="How many seconds to wait for the horde or the image storage to answer a request")
+    arg_parser.add_argument('--max_connections', action="store", required=False, type=int, default=20, help="The maximum amount of open connections to the horde. Downloads have a pool of the same size of their own")
+    arg_parser.add_argument('--max_downloads', action="store", required=False, type=int, default=8, help="The maximum amount of results to download at the same time")
+    arg_parser.add_argument('--result_cache', action="store_true", default=False, required=False, help="Serve requests identical to one already done from a local cache, instead of sending them to the horde again. Use it with a fixed seed, or you will get the same images for the same prompt")
+    arg_parser.add_argument('--result_cache_size', action="store", required=False, type=int, default=1024, help="The maximum size in MB of the result cache")
+    arg_parser.add_argument('--result_cache_ttl', action="store", required=False, type=float, default=24 * 7, help="How many hours results are kept in the result cache")
+    arg_parser.add_argument('--journal', action="store", nargs='?', const="cliRequestsJournal.jsonl", default=None, required=False, help="Record every job in this journal file, so that the run can be resumed. With a journal, Ctrl+C leaves the jobs in the horde instead of cancelling them")
+    arg_parser.add_argument('--resume', action="store_true", default=False, required=False, help="Reattach to the jobs of the journal still in the horde and skip those already saved, instead of submitting them again")
+    arg_parser.add_argument('--metrics_jsonl', action="store", required=False, type=str, help="Write the time every job spent in each phase, and its retries and faults, as json lines in this file")
+    arg_parser.add_argument('--metrics_prom', action="store", required=False, type=str, help="Write the totals of the job metrics in the Prometheus text format in this file, when the run is over")
+    arg_parser.add_argument('--log_jsonl', action="store", required=False, type=str, help="Also write the log as json lines in this file, at INFO level or higher whatever the verbosity")
+    arg_parser.add_argument('--max_retries', action="store", required=False, type=int, default=4, help="How many times a request which failed because of a timeout, a server error or a rate limit is retried")
+    arg_parser.add_argument('--retry_budget', action="store", required=False, type=int, default=100, help="How many retries the whole run can spend over all its requests, before failing ones are given up on")
+    arg_parser.add_argument('--resubmit_faulted', action="store", required=False, type=int, default=1, help="How many times a job which faulted in the horde is submitted again")
+    arg_parser.add_argument('--schedule', action="store", required=False, type=str, default="fifo", choices=SCHEDULE_ORDERS, help="The order batch jobs are submitted in. cheapest submits the jobs estimated to cost the least kudos first, priority those with the highest 'priority' in the batch file")
+    arg_parser.add_argument('--max_kudos', action="store", required=False, type=float, help="Stop submitting jobs once they would cost more than this many kudos in total")
+    arg_parser.add_argument('--no_daemon', action="store_true", default=False, required=False, help="Talk to the horde directly even when a horde daemon is running. When the daemon is used, its own connection and retry options apply instead of these. Runs with --journal, --resume, --result_cache, --metrics_jsonl, --metrics_prom or --max_kudos, or with another --horde than the daemon's, never use it")
+    arg_parser.add_argument('--no_http2', action="store_true", default=False, required=False, help="Only use HTTP/1.1 even when HTTP/2 is available")
+
+
+# Every request goes through a long lived pooled client, so that submits, polls and downloads
+# all reuse the same keep-alive connections instead of doing a new TCP+TLS handshake each time
+def create_http_client(max_connections, timeout, http2=True):
+    return(httpx.AsyncClient(
+        http2=http2 and HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(timeout, connect=min(timeout, 10)),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60,
+        ),
+    ))
+
+
+# A single async client for all horde requests of a process.
+# All jobs share its event loop and connection pools, so we can have hundreds of them pending at the same time.
+# The horde API and the downloads (R2 and any other result URLs) get separate pools,
+# so that a batch of large downloads can never starve the status checks of connections
+class HordeClient(object):
+    def __init__(self, horde_url, min_poll=0.8, max_poll=20, timeout=30, max_connections=20, max_downloads=8, http2=True, result_cache=None, journal=None, resume=False, metrics_prom=None, max_retries=4, retry_budget=100, resubmit_faulted=1, scheduler=None):
+        self.horde_url = horde_url
+        self.metrics_prom = metrics_prom
+        self.result_cache = result_cache
+        self.journal = journal
+        self.resume = resume
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.http = None
+        self.download_http = None
+        # Shared by all jobs, so that a lot of finished jobs can't start hundreds of downloads at once
+        self.download_semaphore = asyncio.Semaphore(max(1, max_downloads))
+        # Requests to the horde and downloads share the retry budget, but only the horde can trip the circuit breaker
+        budget = RetryBudget(retry_budget)
+        self.retry_policy = RetryPolicy(max_attempts=max_retries + 1, budget=budget, breaker=CircuitBreaker())
+        self.download_retry_policy = RetryPolicy(max_attempts=max_retries + 1, budget=budget)
+        self.resubmit_faulted = resubmit_faulted
+        self.progress = ProgressLog()
+        self.scheduler = scheduler or KudosScheduler()
+        # Set once a run was interrupted, so that jobs started on the side (like pipelined alchemy) stop as well
+        self.interrupted = False
+        # For the bandwidth shown on the dashboard
+        self.downloaded_bytes = 0
+
+    @classmethod
+    def from_args(cls, args):
+        result_cache = None
+        if args.result_cache:
+            result_cache = ResultCache(os.path.join(get_cache_dir("results"), "results.sqlite"), args.result_cache_size, args.result_cache_ttl)
+        if args.metrics_jsonl or args.metrics_prom:
+            enable_metrics(args.metrics_jsonl)
+        journal = None
+        if args.journal or args.resume:
+            journal = JobJournal(args.journal or "cliRequestsJournal.jsonl")
+        return(cls(
+            args.horde,
+            timeout=args.timeout,
+            max_connections=args.max_connections,
+            max_downloads=args.max_downloads,
+            http2=not args.no_http2,
+            result_cache=result_cache,
+            journal=journal,
+            resume=args.resume,
+            metrics_prom=args.metrics_prom,
+            max_retries=args.max_retries,
+            retry_budget=args.retry_budget,
+            resubmit_faulted=args.resubmit_faulted,
+            scheduler=KudosScheduler(args.schedule, args.max_kudos),
+        ))
+
+    async def __aenter__(self):
+        self.http = create_http_client(self.max_connections, self.timeout, self.http2)
+        self.download_http = create_http_client(self.max_connections, self.timeout, self.http2)
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.http.aclose()
+        await self.download_http.aclose()
+        if self.journal is not None:
+            self.journal.close()
+        if self.metrics_prom:
+            metrics.write_prometheus(self.metrics_prom)
+
+    async def submit(self, job):
+        if not self.scheduler.admit(job):
+            job.state = "over_budget"
+            return(False)
+        with job.metrics.phase("submit"):
+            submit_req = await self.retry_policy.request(
+                lambda: self.http.post(f'{self.horde_url}{JOB_ENDPOINTS[job.kind]["submit"]}', json = job.submit_dict, headers = job.headers),
+                f"Submitting {job.kind} job" if job.label is None else f"Submitting job {job.label}", job.metrics, idempotent=False,
+            )
+        if not submit_req.is_success:
+            self.scheduler.release(job)
+            logger.error(submit_req.text)
+            job.state = "error"
+            job.error = submit_req.text
+            return(False)
+        job.timer.submitted = time.monotonic()
+        job.submit_results = submit_req.json()
+        logger.debug(job.submit_results)
+        self.scheduler.record_submit(job)
+        job.id = job.submit_results['id']
+        job.state = "submitted"
+        if self.journal is not None:
+            self.journal.record(job, "submitted")
+        return(True)
+
+    # on_check is called with every status the horde sends back, so that callers can act on partial results
+    async def wait(self, job, on_check=None):
+        poll_scheduler = PollScheduler(min_delay=self.min_poll, max_delay=self.max_poll)
+        is_done = False
+        try:
+            while not is_done:
+                chk_req = await self.retry_policy.request(
+                    lambda: self.http.get(f'{self.horde_url}{job.get_endpoint("check")}'),
+                    f"Checking {job.id}", job.metrics,
+                )
+                job.checks += 1
+                if chk_req.status_code == 404 and job.reattached:
+                    logger.warning(f"The horde doesn't know {job.id} anymore. Submitting it again")
+                    job.state = "lost"
+                    return(False)
+                if not chk_req.is_success:
+                    logger.error(chk_req.text)
+                    job.state = "error"
+                    job.error = chk_req.text
+                    return(False)
+                chk_results = chk_req.json()
+                job.log_check(chk_results)
+                self.progress.record(job, chk_results)
+                job.last_check = chk_results
+                if on_check is not None:
+                    on_check(job, chk_results)
+                job.timer.record_check(chk_results)
+                is_done = job.is_check_done(chk_results)
+                if is_done:
+                    job.timer.finish()
+                else:
+                    await asyncio.sleep(poll_scheduler.next_delay(chk_results))
+        finally:
+            self.progress.remove(job)
+        return(True)
+
+    # Fetches the final results. When cancelling, the horde returns whatever was already generated
+    async def retrieve(self, job, cancel=False):
+        with job.metrics.phase("retrieve"):
+            if cancel:
+                logger.info(f"Cancelling {job.id}...")
+                retrieve_req = await self.retry_policy.request(
+                    lambda: self.http.delete(f'{self.horde_url}{job.get_endpoint("status")}'),
+                    f"Cancelling {job.id}", job.metrics,
+                )
+            else:
+                retrieve_req = await self.retry_policy.request(
+                    lambda: self.http.get(f'{self.horde_url}{job.get_endpoint("status")}'),
+                    f"Retrieving {job.id}", job.metrics,
+                )
+        if job.timer.finished is None:
+            job.timer.finish()
+        if not retrieve_req.is_success:
+            logger.error(retrieve_req.text)
+            job.state = "error"
+            job.error = retrieve_req.text
+            return(False)
+        job.results = retrieve_req.json()
+        if job.is_faulted(job.results):
+            job.state = "faulted"
+        elif cancel:
+            job.state = "cancelled"
+        else:
+            job.state = "done"
+        if self.journal is not None:
+            self.journal.record(job, "finished")
+        return(True)
+
+    # Takes a job from submission to its final results. If the job is cancelled while in the horde
+    # we cancel it there as well and keep whatever it already generated
+    async def run_job(self, job, on_check=None):
+        if self.load_cached(job) or self.load_journal(job):
+            return(job)
+        resubmits = 0
+        while True:
+            try:
+                if job.id is None and not await self.submit(job):
+                    return(job)
+                if not await self.wait(job, on_check):
+                    if job.state != "lost":
+                        return(job)
+                    job.id = None
+                    job.reattached = False
+                    if not await self.submit(job) or not await self.wait(job, on_check):
+                        return(job)
+            except asyncio.CancelledError:
+                if job.id is None:
+                    job.state = "cancelled"
+                    return(job)
+                if self.journal is not None:
+                    logger.info(f"Leaving {job.id} in the horde. Use --resume to fetch its results later")
+                    job.state = "detached"
+                    return(job)
+                await self.retrieve(job, cancel=True)
+                return(job)
+            await self.retrieve(job)
+            # A fault is usually down to the worker which picked the job up, so another one might well manage
+            if job.state != "faulted" or resubmits >= self.resubmit_faulted:
+                return(job)
+            resubmits += 1
+            job.metrics.count("resubmits")
+            logger.warning(f"Job {job.name} faulted in the horde. Submitting it again ({resubmits}/{self.resubmit_faulted})")
+            job.id = None
+            job.results = None
+            job.reattached = False
+            job.timer = JobTimer()
+
+    # Runs a job once it gets a slot of the semaphore, which limits how many jobs are in the horde at the same time.
+    # on_done is awaited as soon as the job finishes, outside of the concurrency limit. It returns False when
+    # it couldn't save all the results of the job, so that the journal doesn't mark it as saved
+    async def run_queued(self, job, semaphore, on_done=None, on_check=None):
+        try:
+            async with semaphore:
+                await self.run_job(job, on_check)
+        except asyncio.CancelledError:
+            # Never got a slot, so it never reached the horde
+            if job.state != "pending":
+                raise
+            job.state = "cancelled"
+        except Exception as err:
+            logger.error(f"Job {job.name} failed: {err}")
+            job.state = "error"
+            job.error = str(err)
+        saved = None
+        if on_done is not None:
+            # A job which couldn't be saved mustn't stop the others, which would be left in the horde
+            try:
+                saved = await on_done(job)
+            except Exception as err:
+                logger.error(f"Saving the results of job {job.name} failed: {err}")
+                saved = False
+        self.store_cached(job)
+        # The results are saved and in the cache by now, so a long batch mustn't hold on to every file it downloaded
+        job.blobs = {}
+        metrics.record_job(job)
+        if self.journal is not None and job.state == "done":
+            if saved is False:
+                logger.warning(f"Not all results of job {job.name} were saved. --resume will fetch them again")
+            else:
+                self.journal.record(job, "saved")
+        return(job)
+
+    # Runs all jobs keeping at most `concurrency` of them in the horde at the same time.
+    # The jobs of a batch go in the order of the scheduler, and never more at once than the horde allows the user
+    async def run_jobs(self, jobs, concurrency, on_done=None, on_check=None):
+        scheduled = jobs
+        if len(jobs) > 1:
+            scheduled, concurrency = self.scheduler.plan(jobs, concurrency, await self.find_user(jobs[0].headers))
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        # The semaphore hands out its slots in the order the tasks start waiting for it
+        tasks = [asyncio.create_task(self.run_queued(job, semaphore, on_done, on_check)) for job in scheduled]
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # gather has already passed the cancellation to every job and waited for them to clean up
+            self.interrupted = True
+            logger.warning("Interrupted. All in-flight jobs have been stopped")
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return(jobs)
+
+    # What the horde knows about the user of an api key, like their kudos and how many requests they may have in flight.
+    # The scheduler can do without it, so a failed lookup only gets a warning
+    async def find_user(self, headers):
+        try:
+            user_req = await self.retry_policy.request(
+                lambda: self.http.get(f'{self.horde_url}/api/v2/find_user', headers = headers),
+                "Looking up the user",
+            )
+        except httpx.HTTPError as err:
+            logger.warning(f"Could not look up the user: {err!r}")
+            return(None)
+        if not user_req.is_success:
+            logger.warning(f"Could not look up the user: {user_req.text}")
+            return(None)
+        return(user_req.json())
+
+    async def download_to_file(self, url, filename, job_metrics=None):
+        async with self.download_semaphore:
+            return(await download_to_file(self.download_http, url, filename, self.download_retry_policy, job_metrics))
+
+    # Saves a result URL of a job into filename. Cached jobs are served from the result cache instead,
+    # and when the result cache is on, we keep the bytes of what we download to store them with the job
+    async def fetch_result(self, job, url, filename):
+        if job.cached:
+            if url not in job.blobs:
+                raise ValueError(f"{url} is not one of the cached results of job {job.name}")
+            tmp_filename = f"{filename}.part"
+            with open(tmp_filename, 'wb') as handler:
+                handler.write(job.blobs[url])
+            os.replace(tmp_filename, filename)
+            return(len(job.blobs[url]))
+        with job.metrics.phase("download"):
+            size = await self.download_to_file(url, filename, job.metrics)
+        self.downloaded_bytes += size
+        if self.result_cache is not None:
+            with open(filename, 'rb') as handler:
+                job.blobs[url] = handler.read()
+        return(size)
+
+    # When resuming, jobs already saved are skipped, and jobs which were still in the horde (or finished there
+    # but never saved) are reattached to by their id instead of being submitted and paid for again
+    def load_journal(self, job):
+        if self.journal is None or not self.resume:
+            return(False)
+        entry = self.journal.get(job.journal_key)
+        if entry is None:
+            return(False)
+        if entry["event"] == "saved":
+            logger.info(f"Skipping job {job.name}, as it was already saved by a previous run")
+            job.state = "skipped"
+            return(True)
+        if entry["event"] == "submitted" or entry["event"] == "finished" and entry["state"] == "done":
+            logger.info(f"Reattaching to {entry['id']}")
+            job.id = entry["id"]
+            job.state = "submitted"
+            job.reattached = True
+        # Anything else faulted or was cancelled, so we just do it again
+        return(False)
+
+    def load_cached(self, job):
+        if self.result_cache is None:
+            return(False)
+        cached = self.result_cache.get(ResultCache.get_key(job.kind, job.submit_dict))
+        if cached is None:
+            return(False)
+        job.results, job.blobs = cached
+        job.cached = True
+        job.state = "done"
+        # The job never went through the horde, so it has no queue wait or generation time to skew the stats with
+        job.metrics.count("cached")
+        logger.info(f"Using the cached results of an identical {job.kind} request")
+        return(True)
+
+    # Only complete results go in the cache. A cancelled job or one whose downloads failed would be served broken forever
+    def store_cached(self, job):
+        if self.result_cache is None or job.cached or job.state != "done" or job.results is None:
+            return
+        if len(job.blobs) < len(job.get_result_urls()):
+            return
+        self.result_cache.put(ResultCache.get_key(job.kind, job.submit_dict), job.kind, job.results, job.blobs)
+
+
+# Runs the main coroutine of a CLI. A Ctrl+C cancels the in-flight jobs, which lets them clean up in the horde
+def run_async(coro):
+    try:
+        return(asyncio.run(coro))
+    except KeyboardInterrupt:
+        logger.warning("Interrupted")
@@ -0,0 +1,165 @@
+import base64, hashlib, os, tempfile, threading, time
+from collections import OrderedDict
+
+from cli_logger import logger
+
+# Bump this whenever prepare_image() changes its output, so that old cache entries are not reused
+PREP_VERSION = 2
+
+
+def get_cache_dir(subdir):
+    cache_root = os.environ.get("HORDE_CLI_CACHE")
+    if not cache_root:
+        cache_root = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ai_horde_cli")
+    return(os.path.join(cache_root, subdir))
+
+
+# A small thread-safe LRU of encoded images, so that the same source image is only encoded once per process
+class LRUCache(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return(None)
+            self.entries.move_to_end(key)
+            return(self.entries[key])
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# Encoded images are kept in memory for this process and on disk across runs. The disk tier is an LRU as well:
+# reading an image touches its mtime, and once the images take more than max_disk_size MB, the least recently
+# used ones are removed. Images which haven't been used for max_age_days are removed in any case
+class ImageEncodingCache(object):
+    def __init__(self, cache_dir=None, max_entries=32, max_disk_size=256, max_age_days=30):
+        self.cache_dir = cache_dir
+        self.memory = LRUCache(max_entries)
+        self.max_disk_size = max_disk_size * 1024 * 1024
+        self.max_age = max_age_days * 24 * 3600
+        # What the images on disk take, counted on the first write of this process
+        self.disk_size = None
+        self.disk_lock = threading.Lock()
+        # Hashing a file is cheap, but not free, so we remember the hash of every (path, size, mtime) we've seen
+        self.file_hashes = {}
+
+    def get_file_hash(self, path):
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self.file_hashes:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as handler:
+                for chunk in iter(lambda: handler.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            self.file_hashes[file_key] = sha256.hexdigest()
+        return(self.file_hashes[file_key])
+
+    def _read_disk(self, key):
+        if self.cache_dir is None:
+            return(None)
+        cache_file = os.path.join(self.cache_dir, f"{key}.webp")
+        try:
+            with open(cache_file, 'rb') as handler:
+                encoded = handler.read()
+            os.utime(cache_file)
+        except OSError:
+            # Not cached, or removed by the eviction of a parallel run
+            return(None)
+        return(encoded)
+
+    def _write_disk(self, key, encoded):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written to a temp file first, so that a parallel run never reads half an image
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as handler:
+                handler.write(encoded)
+            os.replace(tmp_file, os.path.join(self.cache_dir, f"{key}.webp"))
+            with self.disk_lock:
+                if self.disk_size is None:
+                    self.evict()
+                else:
+                    self.disk_size += len(encoded)
+                    if self.disk_size > self.max_disk_size:
+                        self.evict()
+        except OSError as err:
+            logger.warning(f"Could not write the image cache in {self.cache_dir}: {err}")
+
+    # Removes the images which are too old, and then the least recently used ones until the rest fits in max_disk_size
+    def evict(self):
+        cache_files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".webp"):
+                stat = entry.stat()
+                cache_files.append((stat.st_mtime, stat.st_size, entry.path))
+        cache_files.sort()
+        self.disk_size = sum(size for mtime, size, path in cache_files)
+        expired = time.time() - self.max_age
+        for mtime, size, path in cache_files:
+            if mtime >= expired and self.disk_size <= self.max_disk_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_size -= size
+
+    def get_key(self, path, role="source", upload_size=None):
+        settings = f"v{PREP_VERSION}-{role}-{upload_size}"
+        return(hashlib.sha256(f"{self.get_file_hash(path)}:{settings}".encode()).hexdigest())
+
+    def _get_cached(self, key):
+        b64_image = self.memory.get(key)
+        if b64_image is not None:
+            return(b64_image)
+        encoded = self._read_disk(key)
+        if encoded is None:
+            return(None)
+        b64_image = base64.b64encode(encoded).decode("utf8")
+        self.memory.put(key, b64_image)
+        return(b64_image)
+
+    def _store(self, key, encoded):
+        self._write_disk(key, encoded)
+        b64_image = base64.b64encode(encoded).decode("utf8")
+        self.memory.put(key, b64_image)
+        return(b64_image)
+
+    # Returns the image file prepared for upload and encoded as WebP in base64, ready to be put in a submit dict.
+    # The result is content-addressed by the hash of the file and the prepare settings
+    def get_b64(self, path, role="source", upload_size=None):
+        key = self.get_key(path, role, upload_size)
+        b64_image = self._get_cached(key)
+        if b64_image is not None:
+            return(b64_image)
+        logger.debug(f"Preparing {path} as {role} at {upload_size}")
+        from cli_image_prep import prepare_image
+        return(self._store(key, prepare_image(path, role, upload_size)))
+
+    # Prepares every image a batch will need which isn't cached yet, in parallel on a process pool.
+    # Afterwards get_b64() is a cache hit for all of them
+    def warm(self, prep_args_list, workers=None):
+        missing = {}
+        for prep_args in prep_args_list:
+            key = self.get_key(*prep_args)
+            if key not in missing and self._get_cached(key) is None:
+                missing[key] = prep_args
+        if not missing:
+            return
+        logger.info(f"Preparing {len(missing)} source images")
+        from cli_image_prep import prepare_images
+        for key, encoded in zip(missing.keys(), prepare_images(list(missing.values()), workers)):
+            self._store(key, encoded)
+
+
+image_cache = ImageEncodingCache(get_cache_dir("encoded_images"))
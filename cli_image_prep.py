@@ -0,0 +1,70 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+LOSSY_QUALITY = 95
+
+
+def round_to_64(value):
+    return(max(64, (int(value) // 64) * 64))
+
+
+# The size we will upload a source image at. The horde will generate at width x height anyway,
+# so anything bigger than that is just wasted bandwidth. We never upscale, the workers do that just as well.
+def get_upload_size(source_size, width=None, height=None):
+    if not width or not height:
+        return(source_size)
+    target_size = (round_to_64(width), round_to_64(height))
+    if source_size[0] * source_size[1] <= target_size[0] * target_size[1]:
+        return(source_size)
+    return(target_size)
+
+
+def has_transparency(img):
+    if img.mode in ["RGBA", "LA", "PA"]:
+        return(img.getchannel("A").getextrema()[0] < 255)
+    return(img.mode == "P" and "transparency" in img.info)
+
+
+# Turns any mask file into a single channel mask where white is the area to repaint.
+# Masks that use transparency for that instead (like inpaint_alpha.png) get their alpha inverted.
+def to_mask(img):
+    if has_transparency(img):
+        return(Image.eval(img.convert("RGBA").getchannel("A"), lambda alpha: 255 - alpha))
+    return(img.convert("L"))
+
+
+# Opens, resizes and encodes a source image or mask as WebP. Runs in worker processes, so it only takes and returns plain values.
+# Masks and images with transparency are encoded losslessly, as compression artifacts would move their edges.
+# Everything else is encoded lossy, which is several times smaller.
+def prepare_image(path, role="source", upload_size=None):
+    img = Image.open(path)
+    if role == "mask":
+        img = to_mask(img)
+        lossless = True
+        resample = Image.NEAREST
+    else:
+        lossless = has_transparency(img)
+        resample = Image.LANCZOS
+    if upload_size is not None and tuple(upload_size) != img.size:
+        img = img.resize(tuple(upload_size), resample)
+    buffer = BytesIO()
+    if lossless:
+        img.save(buffer, format="Webp", lossless=True, exact=True)
+    else:
+        img.save(buffer, format="Webp", quality=LOSSY_QUALITY, exact=True)
+    return(buffer.getvalue())
+
+
+def _prepare_image_args(prep_args):
+    return(prepare_image(*prep_args))
+
+
+# Prepares many images at once on a process pool, so that a batch doesn't encode all its images on the event loop.
+# Returns the encoded images in the same order as the list of (path, role, upload_size) it was given
+def prepare_images(prep_args_list, workers=None):
+    if len(prep_args_list) <= 1:
+        return([_prepare_image_args(prep_args) for prep_args in prep_args_list])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return(list(executor.map(_prepare_image_args, prep_args_list)))
@@ -0,0 +1,51 @@
+import json, os, time
+
+from cli_logger import logger
+
+
+# An append-only record of what happened to every job: submitted (with its horde id), finished and saved.
+# Each line is flushed to disk as soon as it's written, so after a crash or a Ctrl+C we still know which jobs
+# are waiting in the horde and which have already been saved, and a --resume run can pick up from there.
+# When a job shows up more than once, its latest line wins.
+class JobJournal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = self.load()
+        self.handler = open(filename, 'a', encoding='utf-8')
+
+    def load(self):
+        entries = {}
+        if not os.path.exists(self.filename):
+            return(entries)
+        with open(self.filename, 'rt', encoding='utf-8', errors='ignore') as handler:
+            for line in handler:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be half written if we crashed in the middle of it
+                    continue
+                entries.setdefault(record["key"], {}).update(record)
+        logger.debug(f"Loaded {len(entries)} jobs from the journal {self.filename}")
+        return(entries)
+
+    def get(self, key):
+        return(self.entries.get(key))
+
+    def record(self, job, event, **extra):
+        record = {
+            "key": job.journal_key,
+            "event": event,
+            "time": time.time(),
+            "kind": job.kind,
+            "label": job.label,
+            "id": job.id,
+            "state": job.state,
+        }
+        record.update(extra)
+        self.entries.setdefault(record["key"], {}).update(record)
+        self.handler.write(json.dumps(record) + "\n")
+        self.handler.flush()
+        os.fsync(self.handler.fileno())
+
+    def close(self):
+        self.handler.close()
@@ -1,53 +1,99 @@
-import sys
+import json, sys
 from functools import partialmethod
 from loguru import logger
 
-STDOUT_LEVELS = ["GENERATION", "PROMPT"]
-INIT_LEVELS = ["INIT", "INIT_OK", "INIT_WARN", "INIT_ERR"]
-MESSAGE_LEVELS = ["MESSAGE"]
+# The filters run for every record on every sink, so the level names are looked up in sets built once
+STDOUT_LEVELS = frozenset(["GENERATION", "PROMPT"])
+INIT_LEVELS = frozenset(["INIT", "INIT_OK", "INIT_WARN", "INIT_ERR"])
+MESSAGE_LEVELS = frozenset(["MESSAGE"])
+METRIC_LEVELS = frozenset(["METRIC"])
+NON_STDERR_LEVELS = STDOUT_LEVELS | INIT_LEVELS | MESSAGE_LEVELS | METRIC_LEVELS
 # By default we're at error level or higher
 verbosity = 40
 quiet = 0
+# verbosity + quiet. Records below it are not shown
+threshold = 40
 
 def set_logger_verbosity(count):
-    global verbosity
+    global verbosity, threshold
+    configure_logger()
     # The count comes reversed. So count = 0 means minimum verbosity
     # While count 5 means maximum verbosity
     # So the more count we have, the lower we drop the verbosity maximum
     verbosity = 40 - (count * 10)
+    threshold = verbosity + quiet
 
 def quiesce_logger(count):
-    global quiet
+    global quiet, threshold
     # The bigger the count, the more silent we want our logger
     quiet = count * 10
+    threshold = verbosity + quiet
 
 def is_stdout_log(record):
-    if record["level"].name not in STDOUT_LEVELS:
-        return(False)
-    if record["level"].no < verbosity + quiet:
-        return(False)
-    return(True)
+    return(record["level"].name in STDOUT_LEVELS and record["level"].no >= threshold)
 
 def is_init_log(record):
-    if record["level"].name not in INIT_LEVELS:
-        return(False)
-    if record["level"].no < verbosity + quiet:
-        return(False)
-    return(True)
+    return(record["level"].name in INIT_LEVELS and record["level"].no >= threshold)
 
 def is_msg_log(record):
-    if record["level"].name not in MESSAGE_LEVELS:
-        return(False)
-    if record["level"].no < verbosity + quiet:
-        return(False)
-    return(True)
+    return(record["level"].name in MESSAGE_LEVELS and record["level"].no >= threshold)
+
+def is_metric_log(record):
+    return(record["level"].name in METRIC_LEVELS)
 
 def is_stderr_log(record):
-    if record["level"].name in STDOUT_LEVELS + INIT_LEVELS + MESSAGE_LEVELS:
-        return(False)
-    if record["level"].no < verbosity + quiet:
-        return(False)
-    return(True)
+    return(record["level"].name not in NON_STDERR_LEVELS and record["level"].no >= threshold)
+
+# The line the progress dashboard keeps at the bottom of the terminal, if any
+status_line = None
+
+# Writes the records to the terminal above the status line. The status line is cleared before a record
+# and drawn again after it, so that they don't end up garbled together
+class TerminalSink(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, message):
+        if status_line is None or not self.stream.isatty():
+            self.stream.write(message)
+            return
+        self.stream.write("\r\033[K" + message)
+        self.stream.flush()
+        sys.stderr.write(status_line)
+        sys.stderr.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+def set_status_line(line):
+    global status_line
+    status_line = line
+    sys.stderr.write("\r\033[K" + line)
+    sys.stderr.flush()
+
+def clear_status_line():
+    global status_line
+    if status_line is None:
+        return
+    status_line = None
+    sys.stderr.write("\r\033[K")
+    sys.stderr.flush()
+
+# Formats a record as a single json line. The json goes through extra, so that loguru doesn't try to format the braces in it
+def json_format(record):
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "name": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+    }
+    entry.update((key, value) for key, value in record["extra"].items() if key != "json")
+    if record["exception"] is not None:
+        entry["exception"] = repr(record["exception"].value)
+    record["extra"]["json"] = json.dumps(entry, default=str)
+    return("{extra[json]}\n")
 
 def test_logger():
     logger.generation("This is a generation message\nIt is typically multiline\nThee Lines".encode("unicode_escape").decode("utf-8"))
@@ -76,6 +122,8 @@ logger.level("INIT", no=31, color="<white>")
 logger.level("INIT_OK", no=31, color="<green>")
 logger.level("INIT_WARN", no=31, color="<yellow>")
 logger.level("INIT_ERR", no=31, color="<red>")
+# Metrics are below every other level, so that when no metrics sink is added, loguru drops them before doing any work
+logger.level("METRIC", no=5)
 # Messages contain important information without which this application might not be able to be used
 # As such, they have the highest priority
 logger.level("MESSAGE", no=61, color="<green>")
@@ -87,19 +135,46 @@ logger.__class__.init_ok = partialmethod(logger.__class__.log, "INIT_OK")
 logger.__class__.init_warn = partialmethod(logger.__class__.log, "INIT_WARN")
 logger.__class__.init_err = partialmethod(logger.__class__.log, "INIT_ERR")
 logger.__class__.message = partialmethod(logger.__class__.log, "MESSAGE")
+logger.__class__.metric = partialmethod(logger.__class__.log, "METRIC")
 
 config = {
     "handlers": [
-        {"sink": sys.stderr, "format": logfmt, "colorize":True, "filter": is_stderr_log},
-        {"sink": sys.stdout, "format": genfmt, "level": "PROMPT", "colorize":True, "filter": is_stdout_log},
-        {"sink": sys.stdout, "format": initfmt, "level": "INIT", "colorize":True, "filter": is_init_log},
-        {"sink": sys.stdout, "format": msgfmt, "level": "MESSAGE", "colorize":True, "filter": is_msg_log}
+        {"sink": TerminalSink(sys.stderr), "format": logfmt, "colorize":True, "filter": is_stderr_log},
+        {"sink": TerminalSink(sys.stdout), "format": genfmt, "level": "PROMPT", "colorize":True, "filter": is_stdout_log},
+        {"sink": TerminalSink(sys.stdout), "format": initfmt, "level": "INIT", "colorize":True, "filter": is_init_log},
+        {"sink": TerminalSink(sys.stdout), "format": msgfmt, "level": "MESSAGE", "colorize":True, "filter": is_msg_log}
     ],
 }
-logger.configure(**config)
-logger.add("cliRequests.log", retention="7 days", level=19)
-logger.disable("__main__")
-logger.warning("disabled")
-logger.enable("")
-logger.enable(None)
+# Nothing is shown until a CLI sets its verbosity, which is when the handlers are added.
+# That keeps importing this module cheap for the modules which only want to log
+logger.remove()
+handlers_configured = False
+
+def configure_logger():
+    global handlers_configured
+    if handlers_configured:
+        return
+    handlers_configured = True
+    logger.configure(**config)
+    # The log file is only created once something is written to it. Files are written by a background thread
+    # which the records are queued to, so that a slow disk doesn't hold up the event loop with all the jobs on it
+    logger.add("cliRequests.log", retention="7 days", level=19, delay=True, enqueue=True)
+    logger.disable("__main__")
+    logger.warning("disabled")
+    logger.enable("")
+    logger.enable(None)
+
+metrics_enabled = False
+
+# Each job's metrics are logged as a json line into metrics_file. Until this is called, no metrics are collected.
+def enable_metrics(metrics_file=None):
+    global metrics_enabled
+    metrics_enabled = True
+    if metrics_file:
+        logger.add(metrics_file, format="{message}", level="METRIC", filter=is_metric_log, colorize=False, enqueue=True)
 
+# Also writes every record at INFO or higher as a json line into log_file, for log collectors and scripts
+def enable_json_log(log_file=None):
+    if not log_file:
+        return
+    logger.add(log_file, format=json_format, level="INFO", colorize=False, enqueue=True)
@@ -0,0 +1,112 @@
+import json, os, time
+from collections import Counter
+from contextlib import contextmanager
+
+import cli_logger
+from cli_logger import logger
+
+# The phases a job goes through, in order
+PHASES = ["encode", "submit", "queue_wait", "generation", "retrieve", "download", "save"]
+
+
+def percentile(values, pct):
+    if not values:
+        return(None)
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return(ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower))
+
+
+# The time a single job spent in each phase, using the monotonic clock, and how often things went wrong for it
+class JobMetrics(object):
+    def __init__(self):
+        self.phases = {}
+        self.counters = Counter()
+
+    def add(self, phase, seconds):
+        if seconds is None:
+            return
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+
+# Collects the metrics of every finished job of the process. Only does anything once cli_logger.enable_metrics() is called.
+# Each job is logged as a json line as soon as it's done and the totals can be written as a Prometheus text file at the end.
+class MetricsRegistry(object):
+    def __init__(self):
+        self.jobs = Counter()
+        self.counters = Counter()
+        self.phase_values = {}
+
+    def record_job(self, job):
+        if not cli_logger.metrics_enabled:
+            return
+        job.metrics.add("queue_wait", job.timer.queue_wait)
+        job.metrics.add("generation", job.timer.generation_time)
+        job.metrics.counters["checks"] = job.checks
+        if job.state == "faulted":
+            job.metrics.count("faults")
+        self.jobs[(job.kind, job.state)] += 1
+        self.counters.update(job.metrics.counters)
+        for phase, seconds in job.metrics.phases.items():
+            self.phase_values.setdefault(phase, []).append(seconds)
+        logger.metric(json.dumps({
+            "time": time.time(),
+            "kind": job.kind,
+            "label": job.label,
+            "id": job.id,
+            "state": job.state,
+            "cached": job.cached,
+            "kudos": job.kudos,
+            "phases": {phase: round(seconds, 4) for phase, seconds in job.metrics.phases.items()},
+            "counters": dict(job.metrics.counters),
+        }, default=str))
+
+    def get_prometheus(self):
+        lines = [
+            "# HELP horde_cli_jobs_total Finished jobs by kind and final state",
+            "# TYPE horde_cli_jobs_total counter",
+        ]
+        for (kind, state), count in sorted(self.jobs.items()):
+            lines.append(f'horde_cli_jobs_total{{kind="{kind}",state="{state}"}} {count}')
+        lines += [
+            "# HELP horde_cli_events_total Retries, faults, censored images and status checks over all jobs",
+            "# TYPE horde_cli_events_total counter",
+        ]
+        for counter, count in sorted(self.counters.items()):
+            lines.append(f'horde_cli_events_total{{event="{counter}"}} {count}')
+        lines += [
+            "# HELP horde_cli_phase_seconds Time jobs spent in each phase",
+            "# TYPE horde_cli_phase_seconds summary",
+        ]
+        for phase in sorted(self.phase_values, key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES)):
+            values = self.phase_values[phase]
+            for quantile in [50, 90, 99]:
+                lines.append(f'horde_cli_phase_seconds{{phase="{phase}",quantile="{quantile / 100}"}} {percentile(values, quantile):.4f}')
+            lines.append(f'horde_cli_phase_seconds_sum{{phase="{phase}"}} {sum(values):.4f}')
+            lines.append(f'horde_cli_phase_seconds_count{{phase="{phase}"}} {len(values)}')
+        return("\n".join(lines) + "\n")
+
+    # Written to a temp file and renamed, so that a collector never scrapes half a file
+    def write_prometheus(self, prom_file):
+        if not cli_logger.metrics_enabled:
+            return
+        tmp_file = f"{prom_file}.tmp"
+        with open(tmp_file, 'w') as handler:
+            handler.write(self.get_prometheus())
+        os.replace(tmp_file, prom_file)
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,347 @@
+import argparse, base64, json, random, re, struct, threading, time, uuid, zlib, hashlib
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the AI Horde, so the CLIs can be benchmarked and regression tested without hitting aihorde.net.
+# It implements the async, check, status and cancel endpoints for images, text and interrogations, and serves
+# the finished images itself, the way R2 would. It only uses the standard library.
+
+# Which form results are sent as URLs to download, like the horde does for the post-processed images
+ALCHEMY_IMAGE_FORMS = ["GFPGAN", "RealESRGAN_x4plus", "RealESRGAN_x2plus", "RealESRGAN_x4plus_anime_6B", "NMKD_Siax", "4x_AnimeSharp", "CodeFormers", "strip_background"]
+
+
+# A valid PNG of random noise. Noise doesn't compress, so its size is close to what a real generation weighs
+def make_png(width, height, seed=0):
+    rng = random.Random(seed)
+    raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(chunk_type, data):
+        return(struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    return(
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw, 1))
+        + chunk(b'IEND', b'')
+    )
+
+
+# What a request costs in the mock. Roughly proportional to the work, like on the horde, but simpler
+def get_kudos(kind, submit_dict):
+    params = submit_dict.get("params", {})
+    if kind == "interrogate":
+        return(float(len(submit_dict.get("forms", []))))
+    if kind == "text":
+        return(round(params.get("max_length", 80) * params.get("n", 1) / 10, 2))
+    return(round(params.get("steps", 30) * params.get("n", 1) * params.get("width", 512) * params.get("height", 512) / (512 * 512) / 2, 2))
+
+
+class MockHorde(object):
+    def __init__(self, queue_delay=2.0, generation_time=1.0, fault_rate=0.0, rate_limit_rate=0.0, server_error_rate=0.0, image_size=512, user_kudos=10000.0, user_concurrency=30):
+        self.queue_delay = queue_delay
+        self.generation_time = generation_time
+        self.fault_rate = fault_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.image_size = image_size
+        # There is a single user, whoever the api key belongs to
+        self.user_kudos = user_kudos
+        self.user_concurrency = user_concurrency
+        self.jobs = {}
+        self.images = {}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.base_url = None
+
+    def count(self, request_type):
+        with self.lock:
+            self.requests[request_type] += 1
+
+    def get_image(self, size):
+        if size not in self.images:
+            self.images[size] = make_png(size, size, seed=size)
+        return(self.images[size])
+
+    # Returns the id and the kudos of the new job, or None when the user already has as many jobs in flight as they may
+    def submit(self, kind, submit_dict):
+        job_id = str(uuid.uuid4())
+        if kind == "interrogate":
+            amount = len(submit_dict.get("forms", []))
+        else:
+            amount = submit_dict.get("params", {}).get("n", 1)
+        kudos = get_kudos(kind, submit_dict)
+        with self.lock:
+            if self.user_concurrency and self.get_in_flight() >= self.user_concurrency:
+                return(None, 0)
+            self.jobs[job_id] = {
+                "kind": kind,
+                "submit_dict": submit_dict,
+                "amount": amount,
+                "kudos": kudos,
+                "submitted": time.monotonic(),
+                "faulted": random.random() < self.fault_rate,
+                "cancelled": False,
+            }
+            self.user_kudos -= kudos
+        return(job_id, kudos)
+
+    def get_in_flight(self):
+        return(sum(1 for job in self.jobs.values() if self.get_progress(job)[0] != "done"))
+
+    def get_user(self):
+        with self.lock:
+            return({"username": "mock#1", "id": 1, "kudos": self.user_kudos, "concurrency": self.user_concurrency})
+
+    def get_progress(self, job):
+        elapsed = time.monotonic() - job["submitted"]
+        if job["cancelled"] or elapsed >= self.queue_delay + self.generation_time:
+            return("done", 0)
+        if elapsed >= self.queue_delay:
+            return("processing", self.queue_delay + self.generation_time - elapsed)
+        return("waiting", self.queue_delay + self.generation_time - elapsed)
+
+    def get_queue_position(self, job):
+        with self.lock:
+            return(sum(
+                1 for other in self.jobs.values()
+                if other["submitted"] < job["submitted"] and self.get_progress(other)[0] == "waiting"
+            ))
+
+    def get_status(self, job_id, full):
+        job = self.jobs[job_id]
+        progress, wait_time = self.get_progress(job)
+        done = progress == "done"
+        if job["kind"] == "interrogate":
+            return(self.get_interrogation_status(job_id, job, progress))
+        status = {
+            "finished": job["amount"] if done and not job["faulted"] else 0,
+            "processing": job["amount"] if progress == "processing" else 0,
+            "restarted": 0,
+            "waiting": job["amount"] if progress == "waiting" else 0,
+            "done": done,
+            "faulted": done and job["faulted"],
+            "wait_time": int(wait_time),
+            "queue_position": self.get_queue_position(job) if progress == "waiting" else 0,
+            "kudos": job["kudos"],
+            "is_possible": True,
+        }
+        if job["kind"] == "text":
+            status["generations"] = [
+                {"text": f"Mock generation {iter} for: {job['submit_dict'].get('prompt', '')[:40]}", "worker_id": "mock", "worker_name": "Mock Worker", "model": "mock", "seed": iter}
+                for iter in range(status["finished"])
+            ]
+        elif full:
+            status["generations"] = [self.get_image_generation(job_id, job, iter) for iter in range(status["finished"])]
+        return(status)
+
+    def get_image_generation(self, job_id, job, iter):
+        size = min(job["submit_dict"].get("params", {}).get("width", self.image_size), self.image_size)
+        generation = {
+            "id": f"{job_id}_{iter}",
+            "seed": str(job["submit_dict"].get("params", {}).get("seed", iter)),
+            "censored": False,
+            "worker_id": "mock",
+            "worker_name": "Mock Worker",
+            "model": (job["submit_dict"].get("models") or ["stable_diffusion"])[-1],
+            "state": "ok",
+        }
+        if job["submit_dict"].get("r2", True):
+            generation["img"] = f"{self.base_url}/r2/{size}/{job_id}_{iter}.png"
+        else:
+            generation["img"] = base64.b64encode(self.get_image(size)).decode("utf8")
+        return(generation)
+
+    def get_interrogation_status(self, job_id, job, progress):
+        forms = []
+        for form in job["submit_dict"].get("forms", []):
+            name = form["name"]
+            result = {}
+            state = progress
+            if progress == "done":
+                state = "cancelled" if job["cancelled"] else "faulted" if job["faulted"] else "done"
+            if state == "done":
+                if name in ALCHEMY_IMAGE_FORMS:
+                    result[name] = f"{self.base_url}/r2/{self.image_size}/{job_id}_{name}.webp"
+                elif name == "caption":
+                    result[name] = "a mock caption"
+                elif name == "nsfw":
+                    result[name] = False
+                else:
+                    result[name] = {"tags": [{"text": "mock", "confidence": 1.0}]}
+            forms.append({"form": name, "state": state, "result": result})
+        if progress == "done":
+            state = "faulted" if job["faulted"] else "done"
+        else:
+            state = progress
+        return({"state": state, "forms": forms})
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return({"jobs": len(self.jobs), "requests": dict(self.requests)})
+
+
+class MockHordeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    SUBMIT_PATHS = {
+        "/api/v2/generate/async": "image",
+        "/api/v2/generate/text/async": "text",
+        "/api/v2/interrogate/async": "interrogate",
+    }
+    STATUS_REGEX = re.compile(r"^/api/v2/(generate/check|generate/status|generate/text/status|interrogate/status)/([\w-]+)$")
+    R2_REGEX = re.compile(r"^/r2/(\d+)/[\w.-]+$")
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def horde(self):
+        return(self.server.horde)
+
+    def send_json(self, code, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Answers the request with a 429 or a 503 instead, as often as the mock was told to
+    def inject_error(self):
+        if random.random() < self.horde.rate_limit_rate:
+            self.horde.count("rate_limited")
+            self.send_json(429, {"message": "Too many requests"}, {"Retry-After": "1"})
+            return(True)
+        if random.random() < self.horde.server_error_rate:
+            self.horde.count("server_error")
+            self.send_json(503, {"message": "Service unavailable"})
+            return(True)
+        return(False)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/mock/reset":
+            self.horde.reset_stats()
+            return(self.send_json(200, {}))
+        kind = self.SUBMIT_PATHS.get(self.path)
+        if kind is None:
+            return(self.send_json(404, {"message": "Not found"}))
+        self.horde.count("submit")
+        if self.inject_error():
+            return
+        job_id, kudos = self.horde.submit(kind, json.loads(body))
+        if job_id is None:
+            self.horde.count("too_many_requests")
+            return(self.send_json(429, {"message": f"You can only have {self.horde.user_concurrency} requests in flight at the same time", "rc": "TooManyPrompts"}))
+        self.send_json(202, {"id": job_id, "kudos": kudos})
+
+    def do_GET(self):
+        if self.path == "/mock/stats":
+            return(self.send_json(200, self.horde.get_stats()))
+        if self.path == "/api/v2/find_user":
+            self.horde.count("find_user")
+            return(self.send_json(200, self.horde.get_user()))
+        r2_match = self.R2_REGEX.match(self.path)
+        if r2_match:
+            return(self.send_image(int(r2_match.group(1))))
+        self.handle_status(cancel=False)
+
+    def do_DELETE(self):
+        self.handle_status(cancel=True)
+
+    def handle_status(self, cancel):
+        status_match = self.STATUS_REGEX.match(self.path)
+        if status_match is None:
+            return(self.send_json(404, {"message": "Not found"}))
+        endpoint, job_id = status_match.groups()
+        if cancel:
+            self.horde.count("cancel")
+        elif endpoint == "generate/check":
+            self.horde.count("check")
+        elif endpoint == "generate/status":
+            self.horde.count("status")
+        else:
+            self.horde.count("check" if self.is_check_request(job_id) else "status")
+        if self.inject_error():
+            return
+        job = self.horde.jobs.get(job_id)
+        if job is None:
+            return(self.send_json(404, {"message": f"Request {job_id} not found"}))
+        if cancel:
+            job["cancelled"] = True
+        self.send_json(200, self.horde.get_status(job_id, full=endpoint != "generate/check"))
+
+    # The text and interrogation status endpoints are used both to check and to retrieve.
+    # We count a request as a check until the job is done
+    def is_check_request(self, job_id):
+        job = self.horde.jobs.get(job_id)
+        return(job is not None and self.horde.get_progress(job)[0] != "done")
+
+    def send_image(self, size):
+        self.horde.count("download")
+        image = self.horde.get_image(size)
+        start = 0
+        range_match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match.group(1))
+        body = image[start:]
+        self.send_response(206 if range_match else 200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{hashlib.md5(image).hexdigest()}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Starts a mock horde on a background thread. With port 0, a free port is picked
+def start_mock_horde(host="127.0.0.1", port=0, **settings):
+    server = ThreadingHTTPServer((host, port), MockHordeHandler)
+    server.daemon_threads = True
+    server.horde = MockHorde(**settings)
+    server.horde.base_url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return(server)
+
+
+def add_mock_args(arg_parser):
+    arg_parser.add_argument('--queue_delay', action="store", required=False, type=float, default=2.0, help="How many seconds every job waits in the mock queue")
+    arg_parser.add_argument('--generation_time', action="store", required=False, type=float, default=1.0, help="How many seconds every job takes to generate after leaving the queue")
+    arg_parser.add_argument('--fault_rate', action="store", required=False, type=float, default=0.0, help="The fraction of jobs which fault")
+    arg_parser.add_argument('--rate_limit_rate', action="store", required=False, type=float, default=0.0, help="The fraction of requests answered with a 429")
+    arg_parser.add_argument('--server_error_rate', action="store", required=False, type=float, default=0.0, help="The fraction of requests answered with a 503")
+    arg_parser.add_argument('--user_kudos', action="store", required=False, type=float, default=10000.0, help="How many kudos the user starts with")
+    arg_parser.add_argument('--user_concurrency', action="store", required=False, type=int, default=30, help="How many requests the user can have in flight at the same time. More submits are rejected with a 429. 0 means no limit")
+    arg_parser.add_argument('--image_size', action="store", required=False, type=int, default=512, help="The width and height of the images served. Bigger images mean bigger downloads")
+
+
+def get_mock_settings(args):
+    return({
+        "queue_delay": args.queue_delay,
+        "generation_time": args.generation_time,
+        "fault_rate": args.fault_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "server_error_rate": args.server_error_rate,
+        "image_size": args.image_size,
+        "user_kudos": args.user_kudos,
+        "user_concurrency": args.user_concurrency,
+    })
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--host', action="store", required=False, type=str, default="127.0.0.1", help="The address to listen on")
+    arg_parser.add_argument('--port', action="store", required=False, type=int, default=7001, help="The port to listen on")
+    add_mock_args(arg_parser)
+    args = arg_parser.parse_args()
+    server = start_mock_horde(args.host, args.port, **get_mock_settings(args))
+    print(f"Mock horde listening on {server.horde.base_url}. Use it with --horde {server.horde.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,134 @@
+import json, base64, os
+import asyncio
+
+from cli_logger import logger
+from cli_metrics import JobMetrics
+from cli_horde_client import HordeJob
+
+
+# Saves or shows the forms of a finished interrogation. Image forms are saved as {filename}_{form}.webp
+# and the interrogation as {filename}_interrogation.txt. The rest is just shown, along with the filename when show_filename is set.
+# Returns whether all the forms which had something to save were saved
+async def save_forms(client, job, filename, show_filename=False):
+    results = job.results['forms']
+
+    async def save_form(iter):
+        form = results[iter]['form']
+        if results[iter]['state'] == "faulted":
+            logger.warning(f"{results[iter]['form']} has faulted")
+        elif results[iter]['state'] == "cancelled":
+            logger.warning(f"{results[iter]['form']} was cancelled")
+        elif form == "interrogation":
+            final_filename = f"{filename}_{form}.txt"
+            interrogate = json.dumps(results[iter]['result'][form], indent=4)
+            with open(final_filename, 'w') as handler:
+                handler.write(interrogate)
+            logger.generation(f"{form} result saved in: {final_filename}")
+        elif type(results[iter]['result'][form]) is str and results[iter]['result'][form].startswith("http"):
+            final_filename = f"{filename}_{form}.webp"
+            logger.debug(f"Downloading '{form}' from {results[iter]['result'][form]}")
+            try:
+                await client.fetch_result(job, results[iter]['result'][form], final_filename)
+            except Exception as err:
+                logger.error(f"Error: {err}")
+                return(False)
+            logger.generation(f"{form} result saved in: {final_filename}")
+        else:
+            source = f"{filename} " if show_filename else ""
+            logger.generation(f"{source}{form} result: {results[iter]['result'][form]}")
+        return(True)
+
+    # Image forms are downloaded in parallel, within the client's download limit
+    return(all(await asyncio.gather(*[save_form(iter) for iter in range(len(results))])))
+
+
+# Adds the forms of a finished interrogation to the archive instead, as a sample keyed {key}_alchemy next to the
+# sample of its source image. Image forms become its {form}.webp files and the rest goes in its metadata.
+# Returns whether all the forms were archived
+async def archive_forms(client, job, key, archive):
+    files = {}
+    metadata = {"source": key, "forms": {}}
+    complete = True
+    for form_results in job.results['forms']:
+        form = form_results['form']
+        if form_results['state'] != "done":
+            logger.warning(f"{form} of {key} has {form_results['state']}")
+            continue
+        result = form_results['result'][form]
+        if type(result) is str and result.startswith("http"):
+            tmp_filename = os.path.join(archive.directory, f".{key}_alchemy.{form}.webp.download")
+            try:
+                await client.fetch_result(job, result, tmp_filename)
+            except Exception as err:
+                logger.error(f"Error {err} when downloading the {form} of {key}")
+                complete = False
+                continue
+            files[f"{form}.webp"] = tmp_filename
+        else:
+            metadata["forms"][form] = result
+            logger.generation(f"{key} {form} result: {result}")
+    archive.add(f"{key}_alchemy", files, metadata)
+    return(complete)
+
+
+# Runs alchemy forms on images while they are still coming out of dream jobs.
+# Every generation is interrogated as soon as its job is done, while the rest of the batch keeps generating.
+# The horde takes the R2 URL of the generation as the source image, so nothing has to be downloaded and uploaded again.
+# Generations without a URL (no r2, or from the result cache, where the URL might have expired) send their image bytes instead.
+# With an archive, the results go into it instead of next to the images
+class AlchemyPipeline(object):
+    def __init__(self, client, forms, headers, concurrency=4, trusted_workers=False, archive=None):
+        self.client = client
+        self.archive = archive
+        self.forms = forms
+        self.headers = headers
+        self.trusted_workers = trusted_workers
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.tasks = []
+
+    def get_source_image(self, job, generation):
+        img = generation["img"]
+        if not img.startswith("http"):
+            return(img)
+        if job.cached and img in job.blobs:
+            return(base64.b64encode(job.blobs[img]).decode())
+        return(img)
+
+    # Called with each finished generation of a dream job and the filename its image is saved under,
+    # or its key in the archive
+    def feed(self, job, iter, generation, filename):
+        if generation.get("censored"):
+            logger.info(f"Not sending the censored {filename} to alchemy")
+            return
+        submit_dict = {
+            "forms": [{"name": form} for form in self.forms],
+            "source_image": self.get_source_image(job, generation),
+            "trusted_workers": self.trusted_workers,
+        }
+        label = iter if job.label is None else f"{job.label}_{iter}"
+        alchemy_job = HordeJob("interrogate", submit_dict, self.headers, label, job_metrics=JobMetrics())
+        base_filename = filename.rsplit(".", 1)[0]
+
+        async def on_done(alchemy_job):
+            if alchemy_job.state == "faulted":
+                logger.error(f"The alchemy of {filename} faulted")
+            if alchemy_job.results is None:
+                return(None)
+            if self.archive is not None:
+                return(await archive_forms(self.client, alchemy_job, filename, self.archive))
+            return(await save_forms(self.client, alchemy_job, base_filename, show_filename=True))
+
+        self.tasks.append(asyncio.create_task(self.client.run_queued(alchemy_job, self.semaphore, on_done)))
+
+    # Waits for every fed generation to go through alchemy. If the dream jobs were interrupted, this stops the alchemy as well
+    async def join(self):
+        if self.client.interrupted:
+            for task in self.tasks:
+                task.cancel()
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            self.client.interrupted = True
+            logger.warning("Interrupted. All in-flight alchemy jobs have been stopped")
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        return([task.result() for task in self.tasks if not task.cancelled()])
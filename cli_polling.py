@@ -0,0 +1,99 @@
+import random, time
+from email.utils import parsedate_to_datetime
+
+from cli_logger import logger
+
+
+# Reads the Retry-After header of a rate limited response. It can either be seconds or an HTTP date
+def get_retry_after(response, default=None):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return(default)
+    try:
+        return(max(0.0, float(retry_after)))
+    except ValueError:
+        pass
+    try:
+        return(max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+    except (TypeError, ValueError):
+        return(default)
+
+
+# Decides how long to wait until the next status check of a job, based on what the horde last told us about it.
+# We sleep a fraction of the reported wait_time, so the checks get denser as the job nears completion.
+# When the job is stuck deep in the queue, or the horde doesn't give us an ETA, we back off exponentially instead.
+# Every delay gets some jitter so that many jobs submitted together don't all poll at the same instant.
+class PollScheduler(object):
+    def __init__(self, min_delay=0.8, max_delay=20, eta_fraction=0.5, long_queue=20, backoff_factor=1.5, max_delay_without_eta=5, jitter=0.2):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.eta_fraction = eta_fraction
+        self.long_queue = long_queue
+        self.backoff_factor = backoff_factor
+        self.max_delay_without_eta = max_delay_without_eta
+        self.jitter = jitter
+        self.backoff = min_delay
+
+    def _jittered(self, delay):
+        return(min(delay * random.uniform(1 - self.jitter, 1 + self.jitter), self.max_delay))
+
+    def next_delay(self, chk_results):
+        wait_time = chk_results.get("wait_time")
+        queue_position = chk_results.get("queue_position") or 0
+        if wait_time is None:
+            # Interrogations only tell us their state, so we slowly back off up to a short ceiling
+            delay = self.backoff
+            self.backoff = min(self.backoff * self.backoff_factor, self.max_delay_without_eta)
+            return(self._jittered(max(self.min_delay, delay)))
+        delay = wait_time * self.eta_fraction
+        if queue_position >= self.long_queue and not chk_results.get("processing"):
+            self.backoff = min(self.backoff * self.backoff_factor, self.max_delay)
+            delay = max(delay, self.backoff)
+        else:
+            self.backoff = self.min_delay
+        delay = min(max(delay, self.min_delay), self.max_delay)
+        return(self._jittered(delay))
+
+
+# Sums up the last status check of every job in flight into a single log line, at most once every `interval` seconds.
+# A big batch checks hundreds of jobs a second, and a log record for each of them would cost more than the checks
+class ProgressLog(object):
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.checks = {}
+        self.last_logged = None
+
+    def record(self, job, chk_results):
+        self.checks[job] = chk_results
+        now = time.monotonic()
+        if self.last_logged is not None and now - self.last_logged < self.interval:
+            return
+        self.last_logged = now
+        logger.info(self.summary())
+
+    def remove(self, job):
+        self.checks.pop(job, None)
+
+    def summary(self):
+        waiting = processing = finished = 0
+        queue_positions = []
+        wait_times = []
+        for chk_results in self.checks.values():
+            # Interrogations only tell us their state, so each one counts once
+            if "state" in chk_results:
+                waiting += chk_results["state"] == "waiting"
+                processing += chk_results["state"] == "processing"
+                continue
+            waiting += chk_results.get("waiting", 0)
+            processing += chk_results.get("processing", 0)
+            finished += chk_results.get("finished", 0)
+            if chk_results.get("waiting"):
+                queue_positions.append(chk_results.get("queue_position", 0))
+            if chk_results.get("wait_time") is not None:
+                wait_times.append(chk_results["wait_time"])
+        line = f"Jobs in flight: {len(self.checks)}. Generations: {waiting} waiting, {processing} processing, {finished} finished"
+        if queue_positions:
+            line += f". Queue positions {min(queue_positions)}-{max(queue_positions)}"
+        if wait_times:
+            line += f". The last should be done in {max(wait_times)}s"
+        return(line)
@@ -1,21 +1,29 @@
-import requests, json, os, time, argparse, base64
-import yaml
+import json, os, time, argparse, base64
 import sys
 
-from cli_logger import logger, set_logger_verbosity, quiesce_logger, test_logger
-from PIL import Image
-from io import BytesIO
-from requests.exceptions import ConnectionError
+from cli_logger import logger, set_logger_verbosity, quiesce_logger, enable_json_log, test_logger
+from cli_image_cache import image_cache
+from cli_metrics import JobMetrics
+from cli_config import INTERROGATE_SCHEMA
+from cli_pipeline import save_forms
+from cli_horde_client import HordeJob, run_async, add_client_args
+from cli_daemon import AutoClient
 
-arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
-arg_parser.add_argument('-f', '--filename', type=str, action='store', required=False, help="The filename patterrn to use. The type of alchemy will be appended to this.")
-arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
-arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
-arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
-arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
-arg_parser.add_argument('--source_image', action="store", required=False, type=str, help="A file path to an image file must be provided if one is not set in cliRequestsData.")
-args = arg_parser.parse_args()
+
+# The arguments go to a parser of our own when this runs as a script, or to the alchemy subcommand of horde.py
+def add_args(arg_parser):
+    arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
+    arg_parser.add_argument('-f', '--filename', type=str, action='store', required=False, help="The filename patterrn to use. The type of alchemy will be appended to this.")
+    arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
+    arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
+    arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
+    arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
+    arg_parser.add_argument('--source_image', action="store", required=False, type=str, help="A file path to an image file must be provided if one is not set in cliRequestsData.")
+    arg_parser.add_argument('--skip_checks', action="store_true", default=False, required=False, help="Only warn about request data which fails the local checks, like unknown keys or samplers, and send it anyway. For options the horde has which these checks don't know about yet")
+    add_client_args(arg_parser)
+
+
+args = None
 
 
 class RequestData(object):
@@ -34,117 +42,74 @@ class RequestData(object):
     def get_submit_dict(self):
         submit_dict = self.submit_dict.copy()
         if self.source_image: 
-            final_src_img = Image.open(self.source_image)
-            buffer = BytesIO()
-            # We send as WebP to avoid using all the horde bandwidth
-            final_src_img.save(buffer, format="Webp", quality=95, exact=True)
-            submit_dict["source_image"] = base64.b64encode(buffer.getvalue()).decode("utf8")
+            submit_dict["source_image"] = image_cache.get_b64(self.source_image)
         else:
             logger.error("Alchemy requires a source image.")
             sys.exit(1)
         return(submit_dict)
     
 def load_request_data():
-    request_data = RequestData()
-    if os.path.exists("cliRequestsData_Alchemy.yml"):
-        with open("cliRequestsData_Alchemy.yml", "rt", encoding="utf-8", errors="ignore") as configfile:
-            config = yaml.safe_load(configfile)
-            for key, value in config.items():
-                setattr(request_data, key, value)
+    request_data = INTERROGATE_SCHEMA.load(RequestData(), "cliRequestsData_Alchemy.yml", not args.skip_checks)
     if args.api_key: request_data.api_key = args.api_key 
     if args.filename: request_data.filename = args.filename 
     if args.trusted_workers: request_data.submit_dict["trusted_workers"] = args.trusted_workers 
     if args.source_image: request_data.source_image = args.source_image
-    return(request_data)
+    return(INTERROGATE_SCHEMA.validate(request_data, strict=not args.skip_checks))
+
+
+def get_headers(request_data):
+    return({
+        "apikey": request_data.api_key,
+        "Client-Agent": request_data.client_agent,
+    })
+
+
+def create_job(request_data, label=None):
+    job_metrics = JobMetrics()
+    with job_metrics.phase("encode"):
+        submit_dict = request_data.get_submit_dict()
+    job = HordeJob("interrogate", submit_dict, get_headers(request_data), label, request_data, job_metrics)
+    # logger.debug(job.submit_dict)
+    return(job)
+
+
+# Returns False when some of the forms couldn't be saved
+async def save_results(client, job):
+    request_data = job.request_data
+    if job.state == "faulted":
+        final_submit_dict = job.submit_dict.copy()
+        final_submit_dict["source_image"] = f"Alchemy request with size: {len(final_submit_dict['source_image'])}"
+        logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {final_submit_dict}")
+        return
+    if job.results is None:
+        return
+    return(await save_forms(client, job, request_data.filename))
+
+
+async def run_single(request_data):
+    async with AutoClient(args) as client:
+        async def on_done(job):
+            return(await save_results(client, job))
+        await client.run_jobs([create_job(request_data)], 1, on_done)
 
 
 @logger.catch(reraise=True)
 def generate():
     request_data = load_request_data()
-    # final_submit_dict["source_image"] = 'Test'
-    headers = {
-        "apikey": request_data.api_key,
-        "Client-Agent": request_data.client_agent,
-    }
-    # logger.debug(request_data.get_submit_dict())
-    submit_req = requests.post(f'{args.horde}/api/v2/interrogate/async', json = request_data.get_submit_dict(), headers = headers)
-    if submit_req.ok:
-        submit_results = submit_req.json()
-        logger.debug(submit_results)
-        req_id = submit_results['id']
-        is_done = False
-        retry = 0
-        cancelled = False
-        try:
-            while not is_done:
-                try:
-                    chk_req = requests.get(f'{args.horde}/api/v2/interrogate/status/{req_id}')
-                    if not chk_req.ok:
-                        logger.error(chk_req.text)
-                        return
-                    chk_results = chk_req.json()
-                    logger.debug(
-                        [
-                            {
-                                'form': f['form'],
-                                'state': f['state'],
-                            } for f in chk_results['forms']
-                        ]
-                    )
-                    is_done = chk_results['state'] in ["done", "faulted"]
-                    time.sleep(0.8)
-                except ConnectionError as e:
-                    retry += 1
-                    logger.error(f"Error {e} when retrieving status. Retry {retry}/10")
-                    if retry < 10:
-                        time.sleep(1)
-                        continue
-                    raise
-        except KeyboardInterrupt:
-            logger.info(f"Cancelling {req_id}...")
-            cancelled = True
-            retrieve_req = requests.delete(f'{args.horde}/api/v2/interrogate/status/{req_id}')
-        if not cancelled:
-            retrieve_req = requests.get(f'{args.horde}/api/v2/interrogate/status/{req_id}')
-        if not retrieve_req.ok:
-            logger.error(retrieve_req.text)
-            return
-        results_json = retrieve_req.json()
-        # logger.debug(results_json)
-        if results_json['state'] == "faulted":
-            final_submit_dict = request_data.get_submit_dict()
-            final_submit_dict["source_image"] = f"Alchemy request with size: {len(final_submit_dict['source_image'])}"
-            logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {final_submit_dict}")
-            return
-        results = results_json['forms']
-        for iter in range(len(results)):
-            form = results[iter]['form']
-            if results[iter]['state'] == "faulted":
-                logger.warning(f"{results[iter]['form']} has faulted")
-            elif results[iter]['state'] == "cancelled":
-                logger.warning(f"{results[iter]['form']} was cancelled")
-            elif form == "interrogation":
-                final_filename = f"{request_data.filename}_{form}.txt"
-                interrogate = json.dumps(results[iter]['result'][form], indent=4)
-                with open(final_filename, 'w') as handler:
-                    handler.write(interrogate)
-                logger.generation(f"{form} result saved in: {final_filename}")
-            elif type(results[iter]['result'][form]) is str and results[iter]['result'][form].startswith("http"):
-                final_filename = f"{request_data.filename}_{form}.webp"
-                logger.debug(f"Downloading '{form}' from {results[iter]['result'][form]}")
-                try:
-                    img_data = requests.get(results[iter]['result'][form]).content
-                except Exception as err:
-                    logger.error(f"Error: {err}")
-                with open(final_filename, 'wb') as handler:
-                    handler.write(img_data)
-                logger.generation(f"{form} result saved in: {final_filename}")
-            else:
-                logger.generation(f"{form} result: {results[iter]['result'][form]}")
-    else:
-        logger.error(submit_req.text)
-
-set_logger_verbosity(args.verbosity)
-quiesce_logger(args.quiet)
-
-generate()
+    run_async(run_single(request_data))
+
+def main(parsed_args):
+    global args
+    args = parsed_args
+    set_logger_verbosity(args.verbosity)
+    quiesce_logger(args.quiet)
+    enable_json_log(args.log_jsonl)
+
+    generate()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    add_args(arg_parser)
+    main(arg_parser.parse_args())
+
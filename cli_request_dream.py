@@ -1,30 +1,54 @@
-import requests, json, os, time, argparse, base64
-import yaml
+import json, os, time, argparse, base64, uuid
+import asyncio
 import sys
 
-from cli_logger import logger, set_logger_verbosity, quiesce_logger, test_logger
-from PIL import Image
-from io import BytesIO
-from requests.exceptions import ConnectionError
-
-arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument('-n', '--amount', action="store", required=False, type=int, help="The amount of images to generate with this prompt")
-arg_parser.add_argument('-p','--prompt', action="store", required=False, type=str, help="The prompt with which to generate images")
-arg_parser.add_argument('-w', '--width', action="store", required=False, type=int, help="The width of the image to generate. Has to be a multiple of 64")
-arg_parser.add_argument('-l', '--height', action="store", required=False, type=int, help="The height of the image to generate. Has to be a multiple of 64")
-arg_parser.add_argument('-s', '--steps', action="store", required=False, type=int, help="The amount of steps to use for this generation")
-arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
-arg_parser.add_argument('-f', '--filename', type=str, action='store', required=False, help="The filename to use to save the images. If more than 1 image is generated, the number of generation will be prepended")
-arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
-arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
-arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
-arg_parser.add_argument('--nsfw', action="store_true", default=False, required=False, help="Mark the request as NSFW. Only servers which allow NSFW will pick it up")
-arg_parser.add_argument('--censor_nsfw', action="store_true", default=False, required=False, help="If the request is SFW, and the worker accidentaly generates NSFW, it will send back a censored image.")
-arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
-arg_parser.add_argument('--source_image', action="store", required=False, type=str, help="When a file path is provided, will be used as the source for img2img")
-arg_parser.add_argument('--source_processing', action="store", required=False, type=str, help="Can either be img2img, inpainting, or outpainting")
-arg_parser.add_argument('--source_mask', action="store", required=False, type=str, help="When a file path is provided, will be used as the mask source for inpainting/outpainting")
-args = arg_parser.parse_args()
+from cli_logger import logger, set_logger_verbosity, quiesce_logger, enable_json_log, test_logger
+from cli_config import IMAGE_SCHEMA
+from cli_batch import load_batch_file, apply_overrides, BatchStats
+from cli_sweep import load_sweep_file, expand_sweep, ContactSheet
+from cli_pipeline import AlchemyPipeline
+from cli_dashboard import Dashboard
+from cli_archive import ArchiveWriter
+from cli_image_cache import image_cache
+from cli_metrics import JobMetrics
+from cli_horde_client import HordeJob, run_async, add_client_args
+from cli_daemon import AutoClient
+
+
+# The arguments go to a parser of our own when this runs as a script, or to the dream subcommand of horde.py
+def add_args(arg_parser):
+    arg_parser.add_argument('-n', '--amount', action="store", required=False, type=int, help="The amount of images to generate with this prompt")
+    arg_parser.add_argument('-p','--prompt', action="store", required=False, type=str, help="The prompt with which to generate images")
+    arg_parser.add_argument('-w', '--width', action="store", required=False, type=int, help="The width of the image to generate. Has to be a multiple of 64")
+    arg_parser.add_argument('-l', '--height', action="store", required=False, type=int, help="The height of the image to generate. Has to be a multiple of 64")
+    arg_parser.add_argument('-s', '--steps', action="store", required=False, type=int, help="The amount of steps to use for this generation")
+    arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
+    arg_parser.add_argument('-f', '--filename', type=str, action='store', required=False, help="The filename to use to save the images. If more than 1 image is generated, the number of generation will be prepended")
+    arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
+    arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
+    arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
+    arg_parser.add_argument('--nsfw', action="store_true", default=False, required=False, help="Mark the request as NSFW. Only servers which allow NSFW will pick it up")
+    arg_parser.add_argument('--censor_nsfw', action="store_true", default=False, required=False, help="If the request is SFW, and the worker accidentaly generates NSFW, it will send back a censored image.")
+    arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
+    arg_parser.add_argument('--source_image', action="store", required=False, type=str, help="When a file path is provided, will be used as the source for img2img")
+    arg_parser.add_argument('--source_processing', action="store", required=False, type=str, help="Can either be img2img, inpainting, or outpainting")
+    arg_parser.add_argument('--source_mask', action="store", required=False, type=str, help="When a file path is provided, will be used as the mask source for inpainting/outpainting")
+    arg_parser.add_argument('--keep_source_size', action="store_true", default=False, required=False, help="Upload the source image at its original size, instead of downsizing it to the requested width and height")
+    arg_parser.add_argument('--batch_file', action="store", required=False, type=str, help="A .jsonl, .csv or .yml file with one prompt per entry. Any other keys in an entry override the request data for that job only")
+    arg_parser.add_argument('--concurrency', action="store", required=False, type=int, default=4, help="The maximum amount of batch requests to keep in flight on the horde at the same time")
+    arg_parser.add_argument('--archive', action="store", required=False, type=str, help="Append the images and their metadata to sharded tar files in this directory, indexed in its index.jsonl, instead of saving every image as a file of its own")
+    arg_parser.add_argument('--shard_size', action="store", required=False, type=int, default=1024, help="The size in MB after which an archive shard is closed and the next one started")
+    arg_parser.add_argument('--progress', action="store_true", default=False, required=False, help="Show a live status line with the progress of the batch. When the output isn't a terminal, a summary line is written every --progress_interval seconds instead")
+    arg_parser.add_argument('--progress_interval', action="store", required=False, type=float, default=10, help="How many seconds apart the progress summary lines are, when the output isn't a terminal")
+    arg_parser.add_argument('--sweep', action="store", required=False, type=str, help="A .yml or .json sweep spec. Every combination of the values it lists becomes its own job on top of the request data")
+    arg_parser.add_argument('--sweep_index', action="store", required=False, type=str, default="sweep_index.csv", help="Where to write the contact sheet which maps every image of the sweep to its params. Either .csv or .json")
+    arg_parser.add_argument('--alchemy', action="store", required=False, type=str, help="Comma separated alchemy forms (like caption,RealESRGAN_x4plus) to run on every generated image as soon as its job is done. The results are saved next to the image")
+    arg_parser.add_argument('--alchemy_concurrency', action="store", required=False, type=int, default=4, help="The maximum amount of alchemy requests to keep in flight on the horde at the same time")
+    arg_parser.add_argument('--skip_checks', action="store_true", default=False, required=False, help="Only warn about request data which fails the local checks, like unknown keys or samplers, and send it anyway. For options the horde has which these checks don't know about yet")
+    add_client_args(arg_parser)
+
+
+args = None
 
 
 class RequestData(object):
@@ -52,32 +76,52 @@ class RequestData(object):
             self.source_image = None
             self.source_processing = "img2img"
             self.source_mask = None
+            self.keep_source_size = False
+            self.priority = 0
+            self.payload = None
+
+    # The submit dict without the images, built once and shared by every job made from this request data.
+    # Nothing changes the submit dict of a job once it's created
+    def get_payload(self):
+        if self.payload is None:
+            self.payload = dict(self.submit_dict, params=self.imgen_params, source_processing=self.source_processing)
+        return(self.payload)
 
     def get_submit_dict(self):
-        submit_dict = self.submit_dict.copy()
-        submit_dict["params"] = self.imgen_params
-        submit_dict["source_processing"] = self.source_processing
-        if self.source_image: 
-            final_src_img = Image.open(self.source_image)
-            buffer = BytesIO()
-            # We send as WebP to avoid using all the horde bandwidth
-            final_src_img.save(buffer, format="Webp", quality=95, exact=True)
-            submit_dict["source_image"] = base64.b64encode(buffer.getvalue()).decode("utf8")
-        if self.source_mask: 
-            final_src_mask = Image.open(self.source_mask)
-            buffer = BytesIO()
-            # We send as WebP to avoid using all the horde bandwidth
-            final_src_mask.save(buffer, format="Webp", quality=95, exact=True)
-            submit_dict["source_mask"] = base64.b64encode(buffer.getvalue()).decode("utf8")
+        image_preps = self.get_image_preps()
+        if not image_preps:
+            return(self.get_payload())
+        submit_dict = self.get_payload().copy()
+        # The prepared images are cached, so reusing the same source in many jobs only encodes it once
+        for key, prep_args in image_preps:
+            submit_dict[key] = image_cache.get_b64(*prep_args)
         return(submit_dict)
+
+    # The images this request uploads, with the arguments to prepare them: (path, role, upload_size).
+    # The source is downsized to the requested dimensions and the mask is always aligned to the source
+    def get_image_preps(self):
+        if not self.source_image:
+            if self.source_mask:
+                logger.error("A source mask requires a source image.")
+                sys.exit(1)
+            return([])
+        # PIL is only imported by the requests which have images to upload or to convert
+        from PIL import Image
+        from cli_image_prep import get_upload_size
+        source_size = Image.open(self.source_image).size
+        upload_size = source_size
+        if not self.keep_source_size:
+            upload_size = get_upload_size(source_size, self.imgen_params.get("width"), self.imgen_params.get("height"))
+        preps = [("source_image", (self.source_image, "source", upload_size))]
+        if self.source_mask:
+            mask_size = Image.open(self.source_mask).size
+            if abs(mask_size[0] / mask_size[1] - source_size[0] / source_size[1]) > 0.01:
+                logger.warning(f"The source mask {mask_size} has a different aspect ratio than the source image {source_size} and will be stretched to match it")
+            preps.append(("source_mask", (self.source_mask, "mask", upload_size)))
+        return(preps)
     
 def load_request_data():
-    request_data = RequestData()
-    if os.path.exists("cliRequestsData_Dream.yml"):
-        with open("cliRequestsData_Dream.yml", "rt", encoding="utf-8", errors="ignore") as configfile:
-            config = yaml.safe_load(configfile)
-            for key, value in config.items():
-                setattr(request_data, key, value)
+    request_data = IMAGE_SCHEMA.load(RequestData(), "cliRequestsData_Dream.yml", not args.skip_checks)
     if args.api_key: request_data.api_key = args.api_key 
     if args.filename: request_data.filename = args.filename 
     if args.amount: request_data.imgen_params["n"] = args.amount 
@@ -91,88 +135,275 @@ def load_request_data():
     if args.source_image: request_data.source_image = args.source_image
     if args.source_processing: request_data.source_processing = args.source_processing
     if args.source_mask: request_data.source_mask = args.source_mask
-    return(request_data)
+    if args.keep_source_size: request_data.keep_source_size = args.keep_source_size
+    return(IMAGE_SCHEMA.validate(request_data, strict=not args.skip_checks))
 
 
-@logger.catch(reraise=True)
-def generate():
-    request_data = load_request_data()
-    # final_submit_dict["source_image"] = 'Test'
-    headers = {
+def get_headers(request_data):
+    return({
         "apikey": request_data.api_key,
         "Client-Agent": request_data.client_agent,
+    })
+
+
+def create_job(request_data, label=None):
+    job_metrics = JobMetrics()
+    with job_metrics.phase("encode"):
+        submit_dict = request_data.get_submit_dict()
+    job = HordeJob("image", submit_dict, get_headers(request_data), label, request_data, job_metrics, request_data.priority)
+    logger.debug(job.submit_dict)
+    return(job)
+
+
+# What the archive keeps about every image, next to the image itself
+def get_archive_metadata(job, generation):
+    metadata = {
+        "prompt": job.submit_dict.get("prompt"),
+        "params": job.submit_dict.get("params"),
+        "models": job.submit_dict.get("models"),
+        "label": job.label,
+        "id": job.id,
+        "seed": generation.get("seed"),
+        "model": generation.get("model"),
+        "worker_id": generation.get("worker_id"),
+        "worker_name": generation.get("worker_name"),
+        "censored": generation.get("censored", False),
+        "kudos": job.kudos,
+        "queue_wait": job.timer.queue_wait,
+        "generation_time": job.timer.generation_time,
+        "time": time.time(),
     }
-    logger.debug(request_data.get_submit_dict())
-    submit_req = requests.post(f'{args.horde}/api/v2/generate/async', json = request_data.get_submit_dict(), headers = headers)
-    if submit_req.ok:
-        submit_results = submit_req.json()
-        logger.debug(submit_results)
-        req_id = submit_results['id']
-        is_done = False
-        retry = 0
-        cancelled = False
+    if "source_image" in job.submit_dict:
+        metadata["source_processing"] = job.submit_dict.get("source_processing")
+    return(metadata)
+
+
+# The horde gives every generation an id of its own. Results from the result cache get a new one,
+# as the run which cached them might have archived them already
+def get_archive_key(job, generation):
+    if job.cached:
+        return(f"{generation['id']}_{uuid.uuid4().hex[:8]}")
+    return(generation["id"])
+
+
+# Hands an image to the archive under key instead of saving it as a file. A download goes into a temporary file first,
+# which the archive moves into the shard from its own thread
+async def archive_generation(client, job, generation, archive, key):
+    if job.submit_dict["r2"]:
+        extension = generation["img"].split("?")[0].rsplit(".", 1)[-1].lower()
+        tmp_filename = os.path.join(archive.directory, f".{key}.{extension}.download")
+        logger.debug(f"Downloading '{generation['id']}' from {generation['img']}")
         try:
-            while not is_done:
-                try:
-                    chk_req = requests.get(f'{args.horde}/api/v2/generate/check/{req_id}')
-                    if not chk_req.ok:
-                        logger.error(chk_req.text)
-                        return
-                    chk_results = chk_req.json()
-                    logger.info(chk_results)
-                    is_done = chk_results['done']
-                    time.sleep(0.8)
-                except ConnectionError as e:
-                    retry += 1
-                    logger.error(f"Error {e} when retrieving status. Retry {retry}/10")
-                    if retry < 10:
-                        time.sleep(1)
-                        continue
-                    raise
-        except KeyboardInterrupt:
-            logger.info(f"Cancelling {req_id}...")
-            cancelled = True
-            retrieve_req = requests.delete(f'{args.horde}/api/v2/generate/status/{req_id}')
-        if not cancelled:
-            retrieve_req = requests.get(f'{args.horde}/api/v2/generate/status/{req_id}')
-        if not retrieve_req.ok:
-            logger.error(retrieve_req.text)
-            return
-        results_json = retrieve_req.json()
-        # logger.debug(results_json)
-        if results_json['faulted']:
-            final_submit_dict = request_data.get_submit_dict()
-            if "source_image" in final_submit_dict:
-                final_submit_dict["source_image"] = f"img2img request with size: {len(final_submit_dict['source_image'])}"
-            logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {final_submit_dict}")
-            return
-        results = results_json['generations']
-        for iter in range(len(results)):
-            final_filename = request_data.filename
-            if len(results) > 1:
-                final_filename = f"{iter}_{request_data.filename}"
-            if request_data.get_submit_dict()["r2"]:
-                logger.debug(f"Downloading '{results[iter]['id']}' from {results[iter]['img']}")
-                try:
-                    img_data = requests.get(results[iter]["img"]).content
-                except:
-                    logger.error("Received b64 again")
-                with open(final_filename, 'wb') as handler:
-                    handler.write(img_data)
-            else:
+            await client.fetch_result(job, generation["img"], tmp_filename)
+        except Exception as err:
+            logger.error(f"Error {err} when downloading '{generation['id']}'")
+            return(None)
+        archive.add(key, {extension: tmp_filename}, get_archive_metadata(job, generation))
+    else:
+        # The horde sends the images as webp
+        archive.add(key, {"webp": base64.b64decode(generation["img"])}, get_archive_metadata(job, generation))
+    censored = ''
+    if generation["censored"]:
+        censored = " (censored)"
+        job.metrics.count("censored")
+    logger.generation(f"Archived{censored} {key}")
+    return({
+        "file": key,
+        "seed": generation.get("seed"),
+        "model": generation.get("model"),
+        "worker_name": generation.get("worker_name"),
+        "censored": generation.get("censored", False),
+    })
+
+
+# Saves the images of a finished (or cancelled) job under its request's filename, or into the archive.
+# Returns what was saved, so that sweeps can index it. With a pipeline, every image is also sent to alchemy
+async def save_results(client, job, pipeline=None, archive=None):
+    request_data = job.request_data
+    if job.state == "faulted":
+        final_submit_dict = job.submit_dict.copy()
+        if "source_image" in final_submit_dict:
+            final_submit_dict["source_image"] = f"img2img request with size: {len(final_submit_dict['source_image'])}"
+        if "source_mask" in final_submit_dict:
+            final_submit_dict["source_mask"] = f"mask with size: {len(final_submit_dict['source_mask'])}"
+        logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {final_submit_dict}")
+        return([])
+    if job.results is None:
+        return([])
+    results = job.results['generations']
+
+    async def save_generation(iter):
+        final_filename = request_data.filename
+        if len(results) > 1:
+            final_filename = f"{iter}_{request_data.filename}"
+        if archive is not None:
+            # The alchemy results go into the archive as well, next to the image
+            key = get_archive_key(job, results[iter])
+            if pipeline is not None:
+                pipeline.feed(job, iter, results[iter], key)
+            return(await archive_generation(client, job, results[iter], archive, key))
+        if pipeline is not None:
+            pipeline.feed(job, iter, results[iter], final_filename)
+        if job.submit_dict["r2"]:
+            logger.debug(f"Downloading '{results[iter]['id']}' from {results[iter]['img']}")
+            try:
+                await client.fetch_result(job, results[iter]["img"], final_filename)
+            except Exception as err:
+                logger.error(f"Error {err} when downloading '{results[iter]['id']}'")
+                return(None)
+        else:
+            with job.metrics.phase("save"):
+                from PIL import Image
+                from io import BytesIO
                 b64img = results[iter]["img"]
                 base64_bytes = b64img.encode('utf-8')
                 img_bytes = base64.b64decode(base64_bytes)
-                img = Image.open(BytesIO(img_bytes))
-                img.save(final_filename)
-            censored = ''
-            if results[iter]["censored"]:
-                censored = " (censored)"
-            logger.generation(f"Saved{censored} {final_filename}")
+                try:
+                    img = Image.open(BytesIO(img_bytes))
+                    img.save(final_filename)
+                except Exception as err:
+                    logger.error(f"Error {err} when saving '{results[iter]['id']}'")
+                    return(None)
+        censored = ''
+        if results[iter]["censored"]:
+            censored = " (censored)"
+            job.metrics.count("censored")
+        logger.generation(f"Saved{censored} {final_filename}")
+        return({
+            "file": final_filename,
+            "seed": results[iter].get("seed"),
+            "model": results[iter].get("model"),
+            "worker_name": results[iter].get("worker_name"),
+            "censored": results[iter].get("censored", False),
+        })
+
+    # All images of the job are downloaded in parallel, within the client's download limit
+    saved = await asyncio.gather(*[save_generation(iter) for iter in range(len(results))])
+    return([generation for generation in saved if generation is not None])
+
+
+def create_archive():
+    if not args.archive:
+        return(None)
+    return(ArchiveWriter(args.archive, args.shard_size).start())
+
+
+def create_pipeline(client, request_data, archive=None):
+    if not args.alchemy:
+        return(None)
+    forms = [form.strip() for form in args.alchemy.split(",") if form.strip()]
+    return(AlchemyPipeline(client, forms, get_headers(request_data), args.alchemy_concurrency, request_data.submit_dict.get("trusted_workers", False), archive))
+
+
+# Whether all the images of a finished job were saved, for the journal
+def is_saved(job, saved):
+    return(job.results is None or len(saved) == len(job.results['generations']))
+
+
+async def run_single(request_data):
+    archive = create_archive()
+    async with AutoClient(args) as client:
+        pipeline = create_pipeline(client, request_data, archive)
+        async def on_done(job):
+            saved = await save_results(client, job, pipeline, archive)
+            return(is_saved(job, saved))
+        try:
+            await client.run_jobs([create_job(request_data)], 1, on_done)
+            if pipeline is not None:
+                await pipeline.join()
+        finally:
+            if archive is not None:
+                archive.close()
+
+
+# Each batch entry becomes its own job. We keep up to args.concurrency of them in flight
+# and start the next one as soon as any of them finishes
+async def run_batch(jobs_data, contact_sheet=None):
+    stats = BatchStats()
+    jobs = [create_job(job_data, index) for index, job_data in enumerate(jobs_data)]
+    archive = create_archive()
+
+    async with AutoClient(args) as client:
+        # The alchemy of the first images runs while the rest of the batch is still generating
+        pipeline = create_pipeline(client, jobs_data[0], archive) if jobs_data else None
+        async def on_done(job):
+            saved = await save_results(client, job, pipeline, archive)
+            stats.record(job.state, job.timer, job.kudos)
+            if contact_sheet is not None:
+                contact_sheet.add(job, saved)
+            return(is_saved(job, saved))
+        try:
+            if args.progress:
+                async with Dashboard(client, jobs, args.progress_interval):
+                    await client.run_jobs(jobs, args.concurrency, on_done)
+            else:
+                await client.run_jobs(jobs, args.concurrency, on_done)
+            if pipeline is not None:
+                await pipeline.join()
+        finally:
+            # Even an interrupted sweep gets an index of what it managed to save
+            if contact_sheet is not None:
+                contact_sheet.write()
+            # Whatever was already handed to the archive is still written
+            if archive is not None:
+                archive.close()
+    stats.log_summary()
+
+
+@logger.catch(reraise=True)
+def generate():
+    request_data = load_request_data()
+    run_async(run_single(request_data))
+
+
+# Puts every entry of a batch or sweep on top of the request data, and prepares the source images they need.
+# source is the file the entries come from, for the errors
+def prepare_jobs(request_data, entries, source):
+    jobs_data = []
+    for index, entry in enumerate(entries):
+        job_data = apply_overrides(request_data, entry, "imgen_params")
+        if "filename" not in entry:
+            job_data.filename = f"{index}_{request_data.filename}"
+        jobs_data.append(IMAGE_SCHEMA.validate(job_data, f"entry {index + 1} of {source}", not args.skip_checks))
+    # All source images are prepared up front on a process pool, instead of one by one while submitting
+    image_cache.warm([prep_args for job_data in jobs_data for key, prep_args in job_data.get_image_preps()])
+    return(jobs_data)
+
+
+@logger.catch(reraise=True)
+def generate_batch():
+    request_data = load_request_data()
+    entries = load_batch_file(args.batch_file)
+    logger.info(f"Loaded {len(entries)} jobs from {args.batch_file}")
+    run_async(run_batch(prepare_jobs(request_data, entries, args.batch_file)))
+
+
+# A sweep is a batch generated from a spec. All its jobs share the same source image and mask,
+# which are prepared once and then reused by every job from the image cache
+@logger.catch(reraise=True)
+def generate_sweep():
+    request_data = load_request_data()
+    entries = expand_sweep(load_sweep_file(args.sweep))
+    logger.info(f"Expanded {args.sweep} into {len(entries)} jobs")
+    run_async(run_batch(prepare_jobs(request_data, entries, args.sweep), ContactSheet(args.sweep_index, entries)))
+
+def main(parsed_args):
+    global args
+    args = parsed_args
+    set_logger_verbosity(args.verbosity)
+    quiesce_logger(args.quiet)
+    enable_json_log(args.log_jsonl)
+
+    if args.sweep:
+        generate_sweep()
+    elif args.batch_file:
+        generate_batch()
     else:
-        logger.error(submit_req.text)
+        generate()
 
-set_logger_verbosity(args.verbosity)
-quiesce_logger(args.quiet)
 
-generate()
+# The guard keeps the image preparation worker processes from running a generation of their own on spawn platforms
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    add_args(arg_parser)
+    main(arg_parser.parse_args())
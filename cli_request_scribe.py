@@ -1,23 +1,37 @@
-import requests, json, os, time, argparse, base64
-import yaml
+import json, os, time, argparse, base64
 import sys
 
-from cli_logger import logger, set_logger_verbosity, quiesce_logger, test_logger
-from PIL import Image
-from io import BytesIO
-from requests.exceptions import ConnectionError
+from cli_logger import logger, set_logger_verbosity, quiesce_logger, enable_json_log, test_logger
+from cli_metrics import JobMetrics
+from cli_config import TEXT_SCHEMA
+from cli_batch import load_batch_file, apply_overrides, BatchStats
+from cli_stream import JsonlWriter, GenerationStream
+from cli_dashboard import Dashboard
+from cli_horde_client import HordeJob, run_async, add_client_args
+from cli_daemon import AutoClient
 
-arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
-arg_parser.add_argument('-n', '--amount', action="store", required=False, type=int, help="The amount of images to generate with this prompt")
-arg_parser.add_argument('-p','--prompt', action="store", required=False, type=str, help="The prompt with which to generate images")
-arg_parser.add_argument('-c', '--max_context_length', action="store", required=False, type=int, help="The maximum amount of tokens to read from the prompt")
-arg_parser.add_argument('-l', '--max_length', action="store", required=False, type=int, help="The maximum amount of tokens to generate")
-arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
-arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
-arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
-arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
-args = arg_parser.parse_args()
+
+# The arguments go to a parser of our own when this runs as a script, or to the scribe subcommand of horde.py
+def add_args(arg_parser):
+    arg_parser.add_argument('--api_key', type=str, action='store', required=False, help="The API Key to use to authenticate on the Horde. Get one in https://aihorde.net/register")
+    arg_parser.add_argument('-n', '--amount', action="store", required=False, type=int, help="The amount of images to generate with this prompt")
+    arg_parser.add_argument('-p','--prompt', action="store", required=False, type=str, help="The prompt with which to generate images")
+    arg_parser.add_argument('-c', '--max_context_length', action="store", required=False, type=int, help="The maximum amount of tokens to read from the prompt")
+    arg_parser.add_argument('-l', '--max_length', action="store", required=False, type=int, help="The maximum amount of tokens to generate")
+    arg_parser.add_argument('-v', '--verbosity', action='count', default=0, help="The default logging level is ERROR or higher. This value increases the amount of logging seen in your screen")
+    arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The default logging level is ERROR or higher. This value decreases the amount of logging seen in your screen")
+    arg_parser.add_argument('--horde', action="store", required=False, type=str, default="https://aihorde.net", help="Use a different horde")
+    arg_parser.add_argument('--trusted_workers', action="store_true", default=False, required=False, help="If true, the request will be sent only to trusted workers.")
+    arg_parser.add_argument('--batch_file', action="store", required=False, type=str, help="A .jsonl, .csv or .yml file with one prompt per entry. Any other keys in an entry override the request data for that job only")
+    arg_parser.add_argument('--concurrency', action="store", required=False, type=int, default=4, help="The maximum amount of batch requests to keep in flight on the horde at the same time")
+    arg_parser.add_argument('--progress', action="store_true", default=False, required=False, help="Show a live status line with the progress of the batch. When the output isn't a terminal, a summary line is written every --progress_interval seconds instead")
+    arg_parser.add_argument('--progress_interval', action="store", required=False, type=float, default=10, help="How many seconds apart the progress summary lines are, when the output isn't a terminal")
+    arg_parser.add_argument('--jsonl', action="store", required=False, type=str, help="Write every generation as a json line to this file (or - for stdout) as soon as it's finished, instead of showing them at the end")
+    arg_parser.add_argument('--skip_checks', action="store_true", default=False, required=False, help="Only warn about request data which fails the local checks, like unknown keys or samplers, and send it anyway. For options the horde has which these checks don't know about yet")
+    add_client_args(arg_parser)
+
+
+args = None
 
 
 class RequestData(object):
@@ -34,85 +48,112 @@ class RequestData(object):
                 "trusted_workers": False,
                 "models": [],
             }
+            self.priority = 0
+            self.payload = None
 
+    # Built once and shared by every job made from this request data. Nothing changes the submit dict of a job once it's created
     def get_submit_dict(self):
-        submit_dict = self.submit_dict.copy()
-        submit_dict["params"] = self.txtgen_params
-        return(submit_dict)
+        if self.payload is None:
+            self.payload = dict(self.submit_dict, params=self.txtgen_params)
+        return(self.payload)
     
 def load_request_data():
-    request_data = RequestData()
-    if os.path.exists("cliRequestsData_Scribe.yml"):
-        with open("cliRequestsData_Scribe.yml", "rt", encoding="utf-8", errors="ignore") as configfile:
-            config = yaml.safe_load(configfile)
-            for key, value in config.items():
-                setattr(request_data, key, value)
+    request_data = TEXT_SCHEMA.load(RequestData(), "cliRequestsData_Scribe.yml", not args.skip_checks)
     if args.api_key: request_data.api_key = args.api_key 
     if args.amount: request_data.txtgen_params["n"] = args.amount 
     if args.max_context_length: request_data.txtgen_params["max_context_length"] = args.max_context_length 
     if args.max_length: request_data.txtgen_params["max_length"] = args.max_length 
     if args.prompt: request_data.submit_dict["prompt"] = args.prompt 
     if args.trusted_workers: request_data.submit_dict["trusted_workers"] = args.trusted_workers 
-    return(request_data)
+    return(TEXT_SCHEMA.validate(request_data, strict=not args.skip_checks))
+
+
+def get_headers(request_data):
+    return({
+        "apikey": request_data.api_key,
+        "Client-Agent": request_data.client_agent,
+    })
+
+
+def create_job(request_data, label=None):
+    job_metrics = JobMetrics()
+    with job_metrics.phase("encode"):
+        submit_dict = request_data.get_submit_dict()
+    job = HordeJob("text", submit_dict, get_headers(request_data), label, request_data, job_metrics, request_data.priority)
+    # logger.debug(job.submit_dict)
+    return(job)
+
+
+def show_results(job):
+    if job.state == "faulted":
+        logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {job.submit_dict}")
+        return
+    if job.results is None:
+        return
+    results = job.results['generations']
+    for iter in range(len(results)):
+        logger.generation(f"{iter}: {results[iter]['text']}")
+
+
+# Single requests and batches go the same way. When streaming, every generation is written out
+# as soon as a status check shows it finished, while the rest of the jobs are still in the horde
+async def run_jobs(jobs, concurrency):
+    stream = None
+    if args.jsonl:
+        stream = GenerationStream(JsonlWriter(args.jsonl))
+    stats = BatchStats()
+    async with AutoClient(args) as client:
+        async def on_done(job):
+            if stream is None:
+                show_results(job)
+            else:
+                if job.state == "faulted":
+                    show_results(job)
+                stream.on_done(job)
+            stats.record(job.state, job.timer, job.kudos)
+        on_check = stream.on_check if stream is not None else None
+        # Like the summary, the progress lines would end up in the middle of the json lines, unless they go to a terminal
+        if args.progress and (args.jsonl != "-" or sys.stderr.isatty()):
+            async with Dashboard(client, jobs, args.progress_interval):
+                await client.run_jobs(jobs, concurrency, on_done, on_check)
+        else:
+            await client.run_jobs(jobs, concurrency, on_done, on_check)
+    if stream is not None:
+        stream.writer.close()
+    # The summary would end up in the middle of the json lines otherwise
+    if len(jobs) > 1 and args.jsonl != "-":
+        stats.log_summary()
 
 
 @logger.catch(reraise=True)
 def generate():
     request_data = load_request_data()
-    # final_submit_dict["source_image"] = 'Test'
-    headers = {
-        "apikey": request_data.api_key,
-        "Client-Agent": request_data.client_agent,
-    }
-    # logger.debug(request_data.get_submit_dict())
-    submit_req = requests.post(f'{args.horde}/api/v2/generate/text/async', json = request_data.get_submit_dict(), headers = headers)
-    if submit_req.ok:
-        submit_results = submit_req.json()
-        logger.debug(submit_results)
-        req_id = submit_results['id']
-        is_done = False
-        retry = 0
-        cancelled = False
-        try:
-            while not is_done:
-                try:
-                    chk_req = requests.get(f'{args.horde}/api/v2/generate/text/status/{req_id}')
-                    if not chk_req.ok:
-                        logger.error(chk_req.text)
-                        return
-                    chk_results = chk_req.json()
-                    logger.info(chk_results)
-                    is_done = chk_results['done']
-                    time.sleep(0.8)
-                except ConnectionError as e:
-                    retry += 1
-                    logger.error(f"Error {e} when retrieving status. Retry {retry}/10")
-                    if retry < 10:
-                        time.sleep(1)
-                        continue
-                    raise
-        except KeyboardInterrupt:
-            logger.info(f"Cancelling {req_id}...")
-            cancelled = True
-            retrieve_req = requests.delete(f'{args.horde}/api/v2/generate/text/status/{req_id}')
-        if not cancelled:
-            retrieve_req = requests.get(f'{args.horde}/api/v2/generate/text/status/{req_id}')
-        if not retrieve_req.ok:
-            logger.error(retrieve_req.text)
-            return
-        results_json = retrieve_req.json()
-        # logger.debug(results_json)
-        if results_json['faulted']:
-            final_submit_dict = request_data.get_submit_dict()
-            logger.error(f"Something went wrong when generating the request. Please contact the horde administrator with your request details: {final_submit_dict}")
-            return
-        results = results_json['generations']
-        for iter in range(len(results)):
-            logger.generation(f"{iter}: {results[iter]['text']}")
+    run_async(run_jobs([create_job(request_data)], 1))
+
+
+@logger.catch(reraise=True)
+def generate_batch():
+    request_data = load_request_data()
+    entries = load_batch_file(args.batch_file)
+    logger.info(f"Loaded {len(entries)} jobs from {args.batch_file}")
+    jobs_data = [TEXT_SCHEMA.validate(apply_overrides(request_data, entry, "txtgen_params"), f"entry {index + 1} of {args.batch_file}", not args.skip_checks) for index, entry in enumerate(entries)]
+    jobs = [create_job(job_data, index) for index, job_data in enumerate(jobs_data)]
+    run_async(run_jobs(jobs, args.concurrency))
+
+def main(parsed_args):
+    global args
+    args = parsed_args
+    set_logger_verbosity(args.verbosity)
+    quiesce_logger(args.quiet)
+    enable_json_log(args.log_jsonl)
+
+    if args.batch_file:
+        generate_batch()
     else:
-        logger.error(submit_req.text)
+        generate()
 
-set_logger_verbosity(args.verbosity)
-quiesce_logger(args.quiet)
 
-generate()
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    add_args(arg_parser)
+    main(arg_parser.parse_args())
@@ -0,0 +1,71 @@
+import hashlib, json, os, sqlite3, time
+
+from cli_logger import logger
+
+
+# A local store of finished horde results, keyed by the exact request that produced them.
+# The final status json is stored along with the bytes of every result the horde only sent as a URL (R2 images, alchemy forms),
+# as those URLs expire long before the cache entries do.
+# Entries older than the TTL are dropped and the least recently used ones are evicted when the store gets too big.
+class ResultCache(object):
+    def __init__(self, db_file, max_size_mb=1024, ttl_hours=24 * 7):
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.ttl = ttl_hours * 3600
+        self.db = sqlite3.connect(db_file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, kind TEXT, results TEXT, created REAL, last_access REAL, size INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT, url TEXT, data BLOB, PRIMARY KEY (key, url))")
+        self.db.commit()
+
+    # The same request is always the same json once its keys are sorted, whatever order they were written in
+    @staticmethod
+    def get_key(kind, submit_dict):
+        canonical = json.dumps({"kind": kind, "submit_dict": submit_dict}, sort_keys=True, separators=(",", ":"))
+        return(hashlib.sha256(canonical.encode("utf-8")).hexdigest())
+
+    def _delete(self, key):
+        self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self.db.execute("DELETE FROM blobs WHERE key = ?", (key,))
+
+    # Returns (results, blobs) for a request we've seen before, or None
+    def get(self, key):
+        row = self.db.execute("SELECT results, created FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return(None)
+        now = time.time()
+        if now - row[1] > self.ttl:
+            self._delete(key)
+            self.db.commit()
+            return(None)
+        self.db.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        blobs = dict(self.db.execute("SELECT url, data FROM blobs WHERE key = ?", (key,)).fetchall())
+        return(json.loads(row[0]), blobs)
+
+    def put(self, key, kind, results, blobs=None):
+        blobs = blobs or {}
+        results_json = json.dumps(results)
+        size = len(results_json) + sum(len(data) for data in blobs.values())
+        if size > self.max_size:
+            logger.warning(f"Not caching a result of {size} bytes, as it's bigger than the whole result cache")
+            return
+        now = time.time()
+        self._delete(key)
+        self.db.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", (key, kind, results_json, now, now, size))
+        self.db.executemany("INSERT INTO blobs VALUES (?, ?, ?)", [(key, url, data) for url, data in blobs.items()])
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        expired = self.db.execute("SELECT key FROM results WHERE created < ?", (time.time() - self.ttl,)).fetchall()
+        for (key,) in expired:
+            self._delete(key)
+        total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY last_access ASC").fetchall():
+            self._delete(key)
+            total_size -= size
+            if total_size <= self.max_size:
+                break
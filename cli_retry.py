@@ -0,0 +1,164 @@
+import asyncio, random, socket, time
+import httpx
+
+from cli_logger import logger
+from cli_polling import get_retry_after
+
+# Status codes which mean the horde (or something in front of it) is struggling, rather than our request being wrong
+SERVER_ERROR_CODES = {500, 502, 503, 504, 520, 521, 522, 523, 524}
+# When these happen the request never reached the horde, so even a submit can safely be sent again
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+# httpx wraps the socket errors into its own, so we have to look down the chain for what really happened
+def _caused_by(err, error_type):
+    while err is not None:
+        if isinstance(err, error_type):
+            return(True)
+        err = err.__cause__ or err.__context__
+    return(False)
+
+
+# Puts a failed request into one of the error classes we know how to retry, or returns None when retrying won't help.
+# A request which isn't idempotent (a submit) is only retried when we know the horde never acted on it,
+# since a timeout on a submit might have still created the job and we'd pay for it twice
+def classify_error(err=None, response=None, idempotent=True):
+    if response is not None:
+        if response.status_code == 429:
+            return("rate_limited")
+        if response.status_code in [502, 503] or idempotent and response.status_code in SERVER_ERROR_CODES:
+            return("server")
+        return(None)
+    if isinstance(err, httpx.ConnectError) and _caused_by(err, socket.gaierror):
+        return("dns")
+    if isinstance(err, CONNECT_ERRORS):
+        return("connection")
+    if not idempotent:
+        return(None)
+    if isinstance(err, httpx.TimeoutException):
+        return("timeout")
+    if isinstance(err, httpx.TransportError):
+        return("connection")
+    return(None)
+
+
+# How many retries the whole run may spend. A long batch survives the odd blip,
+# but when everything is failing we give up instead of retrying every job to its own limit
+class RetryBudget(object):
+    def __init__(self, max_retries=100):
+        self.max_retries = max_retries
+        self.spent = 0
+
+    def spend(self):
+        if self.max_retries is not None and self.spent >= self.max_retries:
+            if self.spent == self.max_retries:
+                logger.error(f"All {self.max_retries} retries of this run have been used. Failing requests won't be retried anymore")
+                self.spent += 1
+            return(False)
+        self.spent += 1
+        return(True)
+
+
+# Stops every job from sending requests for a while after the horde failed too many of them in a row,
+# instead of all of them hammering it with their own retries. Once the cooldown is over, a single
+# trial request goes through. If it works, everyone resumes. If not, we wait for another cooldown.
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    @property
+    def is_open(self):
+        return(self.opened_at is not None)
+
+    def record_success(self):
+        if self.is_open:
+            logger.info("The horde is answering again. Resuming all requests")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.is_open:
+            # The trial request failed as well
+            self.opened_at = time.monotonic()
+            self.trial_at = None
+        elif self.failures >= self.failure_threshold:
+            logger.warning(f"The horde failed {self.failures} requests in a row. Pausing all requests for {self.cooldown}s")
+            self.opened_at = time.monotonic()
+
+    async def wait(self):
+        while self.is_open:
+            now = time.monotonic()
+            remaining = self.opened_at + self.cooldown - now
+            # A trial which never reported back (it was cancelled) doesn't block the others forever
+            if remaining <= 0 and (self.trial_at is None or now - self.trial_at > self.cooldown):
+                self.trial_at = now
+                return
+            await asyncio.sleep(max(remaining, 1))
+
+
+# Decides whether and when a failed request is sent again. The delay grows exponentially with full jitter,
+# so that many jobs failing at the same moment don't all come back at the same moment either.
+# A Retry-After from the horde always wins. The budget and the circuit breaker are shared by all requests of a client.
+class RetryPolicy(object):
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=30, budget=None, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker = breaker
+
+    def get_delay(self, attempt, retry_after=None):
+        delay = random.uniform(self.base_delay / 2, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return(delay)
+
+    # Called after a failed attempt. Sleeps and returns True if the request should be sent again
+    async def backoff(self, attempt, error_class, description, job_metrics=None, retry_after=None):
+        if attempt >= self.max_attempts:
+            return(False)
+        if self.budget is not None and not self.budget.spend():
+            return(False)
+        if job_metrics is not None:
+            job_metrics.count("rate_limited" if error_class == "rate_limited" else "retries")
+        delay = self.get_delay(attempt, retry_after)
+        logger.warning(f"{description} ({error_class}). Retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        return(True)
+
+    # Sends a request with send() until it works or it's no use trying again. When we give up on an error response,
+    # that response is returned for the caller to handle, like any other unsuccessful response
+    async def request(self, send, description, job_metrics=None, idempotent=True):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.breaker is not None:
+                await self.breaker.wait()
+            try:
+                response = await send()
+            except httpx.TransportError as err:
+                error_class = classify_error(err, idempotent=idempotent)
+                if error_class is None:
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if not await self.backoff(attempt, error_class, f"{description} failed with {err!r}", job_metrics):
+                    raise
+                continue
+            error_class = classify_error(response=response, idempotent=idempotent)
+            if error_class is None:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return(response)
+            # Being rate limited means the horde is fine, we are just too fast
+            if self.breaker is not None and error_class != "rate_limited":
+                self.breaker.record_failure()
+            retry_after = get_retry_after(response)
+            if not await self.backoff(attempt, error_class, f"{description} got {response.status_code}", job_metrics, retry_after):
+                return(response)
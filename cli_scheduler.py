@@ -0,0 +1,103 @@
+from cli_logger import logger
+
+# The orders a batch can be submitted in. fifo keeps the order of the batch file
+SCHEDULE_ORDERS = ["fifo", "cheapest", "priority"]
+# Samplers which evaluate the model twice per step, which the horde charges as twice the steps
+DOUBLE_STEP_SAMPLERS = {"k_heun", "k_dpm_2", "k_dpm_2_a", "k_dpmpp_2s_a"}
+
+
+# A rough estimate of what a job will cost, priced the way the horde does it. Images by their resolution and
+# the steps that actually run (img2img only runs the part its denoising strength leaves), with extra for
+# post-processing and controlnet. Text by the tokens asked for, since the model size isn't known up front.
+# The kudos the horde sends back on every submit are used to correct these as the batch goes
+def estimate_kudos(job):
+    params = job.submit_dict.get("params", {})
+    amount = params.get("n", 1)
+    if job.kind == "interrogate":
+        return(float(len(job.submit_dict.get("forms", []))))
+    if job.kind == "text":
+        return(params.get("max_length", 80) * amount / 20)
+    resolution = pow(max(params.get("width", 512) * params.get("height", 512) - 64 * 64, 0), 1.75) / pow(1024 * 1024 - 64 * 64, 1.75)
+    steps = params.get("steps", 30)
+    if params.get("sampler_name") in DOUBLE_STEP_SAMPLERS:
+        steps *= 2
+    if job.submit_dict.get("source_image") and job.submit_dict.get("source_processing", "img2img") == "img2img":
+        steps *= params.get("denoising_strength", 0.8)
+    kudos = 0.1232 * steps + resolution * 0.1232 * steps * 8.75
+    kudos *= 1.2 ** len(params.get("post_processing", []))
+    if params.get("control_type"):
+        kudos *= 3
+    return(kudos * amount)
+
+
+# Decides in which order the jobs of a batch are submitted and whether they fit in the kudos budget.
+# Cheaper jobs first gets the most finished jobs out of the kudos and the time we have. Priority runs
+# the jobs with the highest priority of the batch file first, and the cheapest of those before the rest.
+# The horde only lets a user have so many requests in flight, so the concurrency is capped to that
+# instead of having the extra submits rejected.
+class KudosScheduler(object):
+    def __init__(self, order="fifo", max_kudos=None):
+        if order not in SCHEDULE_ORDERS:
+            raise ValueError(f"Unknown schedule '{order}'. Please use one of {SCHEDULE_ORDERS}")
+        self.order = order
+        self.max_kudos = max_kudos
+        # What the submitted jobs cost, counting our estimate for those the horde hasn't answered yet
+        self.spent = 0
+        # The kudos the horde charged and what we had estimated for the same jobs, by job kind
+        self.calibration = {}
+
+    def get_cost(self, job):
+        estimate = estimate_kudos(job)
+        charged, estimated = self.calibration.get(job.kind, (0, 0))
+        if estimated > 0:
+            return(estimate * charged / estimated)
+        return(estimate)
+
+    # The sort is stable, so jobs which cost the same keep their batch order
+    def sort(self, jobs):
+        if self.order == "cheapest":
+            return(sorted(jobs, key=self.get_cost))
+        if self.order == "priority":
+            return(sorted(jobs, key=lambda job: (-job.priority, self.get_cost(job))))
+        return(list(jobs))
+
+    # Orders the jobs of a batch and caps its concurrency to what the user can have in flight.
+    # user is what the horde knows about the user of the api key, or None if we couldn't find out
+    def plan(self, jobs, concurrency, user=None):
+        jobs = self.sort(jobs)
+        total = sum(self.get_cost(job) for job in jobs)
+        logger.info(f"The {len(jobs)} jobs of this batch should cost about {total:.0f} kudos")
+        if user is None:
+            return(jobs, concurrency)
+        if user.get("kudos") is not None and total > user["kudos"]:
+            logger.warning(f"This batch should cost about {total:.0f} kudos, but {user.get('username', 'you')} only has {user['kudos']:.0f}. The horde might start rejecting its jobs")
+        if user.get("concurrency") and concurrency > user["concurrency"]:
+            logger.info(f"Keeping at most {user['concurrency']} jobs in flight, which is as many as the horde accepts from {user.get('username', 'this user')}")
+            concurrency = user["concurrency"]
+        return(jobs, concurrency)
+
+    # Called right before a job is submitted. Returns False when it would go over the budget.
+    # Cheaper jobs later in the batch might still fit, so a refused job doesn't stop the rest
+    def admit(self, job):
+        cost = self.get_cost(job)
+        if self.max_kudos is not None and self.spent + cost > self.max_kudos:
+            logger.warning(f"Not submitting job {job.name}, as its ~{cost:.1f} kudos would go over the budget of {self.max_kudos} ({self.spent:.1f} spent)")
+            return(False)
+        self.spent += cost
+        job.kudos = cost
+        return(True)
+
+    # The horde didn't take the job, so it didn't cost anything
+    def release(self, job):
+        self.spent -= job.kudos
+        job.kudos = 0
+
+    # Replaces our estimate with what the horde says the job costs
+    def record_submit(self, job):
+        charged = job.submit_results.get("kudos")
+        if charged is None:
+            return
+        charged_total, estimated_total = self.calibration.get(job.kind, (0, 0))
+        self.calibration[job.kind] = (charged_total + charged, estimated_total + estimate_kudos(job))
+        self.spent += charged - job.kudos
+        job.kudos = charged
@@ -0,0 +1,60 @@
+import json, sys, threading
+
+
+# Writes results as json lines to stdout ("-") or a file, flushing every line,
+# so that whatever consumes them can start working before the rest of the run is over
+class JsonlWriter(object):
+    def __init__(self, output):
+        self.to_stdout = output == "-"
+        self.handler = sys.stdout if self.to_stdout else open(output, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.handler.write(line)
+            self.handler.flush()
+
+    def close(self):
+        if not self.to_stdout:
+            self.handler.close()
+
+
+# Emits every text generation of a job exactly once, as soon as the horde shows it as finished.
+# The text status lists the finished generations while the rest of the job is still running,
+# so with n > 1 the first texts come out long before the job is done
+class GenerationStream(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.emitted = {}
+
+    def emit_generations(self, job, generations):
+        emitted = self.emitted.setdefault(id(job), set())
+        for index, generation in enumerate(generations):
+            if index in emitted:
+                continue
+            emitted.add(index)
+            record = {
+                "job": job.label,
+                "id": job.id,
+                "index": index,
+                "prompt": job.submit_dict.get("prompt"),
+                "text": generation.get("text"),
+                "model": generation.get("model"),
+                "worker_id": generation.get("worker_id"),
+                "worker_name": generation.get("worker_name"),
+                "seed": generation.get("seed"),
+            }
+            self.writer.write(record)
+
+    def on_check(self, job, chk_results):
+        self.emit_generations(job, chk_results.get("generations", []))
+
+    # Whatever the checks didn't show yet comes out now. Jobs which didn't end well get a line with their state,
+    # so that consumers know not to wait for them
+    def on_done(self, job):
+        if job.results is not None:
+            self.emit_generations(job, job.results.get("generations", []))
+        if job.state != "done":
+            self.writer.write({"job": job.label, "id": job.id, "state": job.state, "error": job.error})
+        self.emitted.pop(id(job), None)
@@ -0,0 +1,129 @@
+import csv, hashlib, json, os, random, sys, itertools
+
+from cli_logger import logger
+
+SWEEP_MODES = ["grid", "list"]
+
+
+# Reads a sweep spec from a .yml or .json file. It looks like this:
+#   mode: grid          # grid runs every combination of the values. list runs the values side by side
+#   params:
+#     steps: [20, 30]
+#     cfg_scale: [5, 7.5]
+#     sampler_name: ["k_euler_a", "k_dpm_2"]
+#   seeds: 3            # A list of seeds, or how many random ones to pick. Every combination runs once per seed
+#   seed_base: 42       # Optional. What the random seeds are picked from, instead of the rest of the spec
+# A file which can't be read stops the run with an error
+def load_sweep_file(sweep_file):
+    try:
+        return(_read_sweep_file(sweep_file))
+    except (OSError, ValueError) as err:
+        logger.error(f"Could not load the sweep file {sweep_file}: {err}")
+        sys.exit(1)
+
+
+def _read_sweep_file(sweep_file):
+    if not os.path.exists(sweep_file):
+        raise FileNotFoundError("The file does not exist")
+    extension = os.path.splitext(sweep_file)[1].lower()
+    with open(sweep_file, "rt", encoding="utf-8", errors="ignore") as sweepfile:
+        if extension == ".json":
+            spec = json.load(sweepfile)
+        elif extension in [".yml", ".yaml"]:
+            import yaml
+            try:
+                spec = yaml.safe_load(sweepfile)
+            except yaml.YAMLError as err:
+                raise ValueError(f"Not valid YAML: {err}")
+        else:
+            raise ValueError(f"Unknown sweep file type '{extension}'. Please use .yml or .json")
+    if type(spec) is not dict or type(spec.get("params", {})) is not dict:
+        raise ValueError("It has to be a mapping with a 'params' mapping of values to sweep")
+    return(spec)
+
+
+def _get_seeds(spec):
+    seeds = spec.get("seeds")
+    if seeds is None:
+        return([None])
+    if type(seeds) is int:
+        # Picked here rather than by the workers, so that the contact sheet can tell which seed made which image.
+        # The same spec always picks the same seeds, or --resume would find none of its jobs in the journal
+        seed_base = spec.get("seed_base")
+        if seed_base is None:
+            seed_base = hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        seed_random = random.Random(str(seed_base))
+        return([str(seed_random.randint(0, 2**32 - 1)) for _ in range(seeds)])
+    if type(seeds) is not list:
+        seeds = [seeds]
+    return([str(seed) for seed in seeds])
+
+
+# Expands a sweep spec into a list of batch entries, which apply_overrides() can put on top of the request data
+def expand_sweep(spec):
+    mode = spec.get("mode", "grid")
+    if mode not in SWEEP_MODES:
+        logger.error(f"Unknown sweep mode '{mode}'. Please use one of {SWEEP_MODES}")
+        sys.exit(1)
+    params = {}
+    # A single value instead of a list is used as is by every job
+    constants = {}
+    for key, values in (spec.get("params") or {}).items():
+        if type(values) is list:
+            params[key] = values
+        else:
+            constants[key] = values
+    keys = list(params)
+    if mode == "grid":
+        combinations = list(itertools.product(*params.values()))
+    else:
+        lengths = {len(values) for values in params.values()}
+        if len(lengths) > 1:
+            logger.error(f"All params of a list sweep need the same amount of values. Got: { {key: len(values) for key, values in params.items()} }")
+            sys.exit(1)
+        combinations = list(zip(*params.values()))
+    entries = []
+    for seed in _get_seeds(spec):
+        for combination in combinations:
+            entry = dict(constants)
+            entry.update(zip(keys, combination))
+            if seed is not None:
+                entry["seed"] = seed
+            entries.append(entry)
+    return(entries)
+
+
+# Maps every saved image of a sweep to the params which made it, so the results can be compared side by side.
+# Written as CSV or JSON, depending on the extension of the filename
+class ContactSheet(object):
+    def __init__(self, filename, entries):
+        self.filename = filename
+        self.entries = entries
+        self.rows = []
+
+    def add(self, job, saved):
+        entry = self.entries[job.label]
+        if not saved:
+            self.rows.append({"job": job.label, "state": job.state, "file": None, **entry})
+            return
+        for generation in saved:
+            row = {"job": job.label, "state": job.state}
+            row.update(entry)
+            row.update(generation)
+            self.rows.append(row)
+
+    def write(self):
+        self.rows.sort(key=lambda row: (row["job"], row.get("file") or ""))
+        if os.path.splitext(self.filename)[1].lower() == ".json":
+            with open(self.filename, 'w', encoding='utf-8') as handler:
+                json.dump(self.rows, handler, indent=4)
+        else:
+            columns = []
+            for row in self.rows:
+                columns += [key for key in row if key not in columns]
+            with open(self.filename, 'w', encoding='utf-8', newline='') as handler:
+                writer = csv.DictWriter(handler, fieldnames=columns)
+                writer.writeheader()
+                for row in self.rows:
+                    writer.writerow({key: json.dumps(value) if type(value) in [list, dict] else value for key, value in row.items()})
+        logger.message(f"Wrote the contact sheet of {len(self.rows)} images to {self.filename}")
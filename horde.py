@@ -0,0 +1,32 @@
+import argparse, importlib, sys
+
+# A single entry point for all the CLIs: python horde.py dream|scribe|alchemy [arguments].
+# Only the module of the chosen subcommand is imported, and each of them only imports what its own
+# requests need (PIL for images, yaml when there is a config file), so that a text request
+# started from a shell loop doesn't pay for the startup of the image ones.
+COMMANDS = {
+    "dream": ("cli_request_dream", "Generate images with the Stable Horde"),
+    "scribe": ("cli_request_scribe", "Generate text with the Kobold Horde"),
+    "alchemy": ("cli_request_alchemy", "Caption, interrogate or post-process images"),
+    "daemon": ("cli_daemon", "Keep a client running in the background, which the other commands hand their jobs to"),
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    arg_parser = argparse.ArgumentParser(prog="horde", description="Send requests to the AI Horde")
+    subparsers = arg_parser.add_subparsers(dest="command", metavar="{" + ",".join(COMMANDS) + "}")
+    subparsers.required = True
+    command_module = None
+    for command, (module_name, help) in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=help, description=help)
+        if argv and argv[0] == command:
+            command_module = importlib.import_module(module_name)
+            command_module.add_args(subparser)
+    args = arg_parser.parse_args(argv)
+    command_module.main(args)
+
+
+if __name__ == "__main__":
+    main()